@@ -1,33 +1,107 @@
 
-import os, json
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify, abort
+import os, io, re, csv, gzip, json, time, uuid, fcntl, queue, socket, mimetypes, sqlite3, hashlib, tempfile, threading, unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from urllib.parse import quote
+import click
+from contextlib import contextmanager
+from functools import wraps
+from flask import (Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash,
+                   send_file, send_from_directory, stream_with_context, jsonify, abort, g, has_app_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import selectinload
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
-from PIL import Image
-import pandas as pd
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET', 'dev-secret-change-me')
+def default_config():
+    """Configuración desde variables de entorno; create_app(config) permite pisar cualquier clave."""
+    return {
+        'SECRET_KEY': os.environ.get('FLASK_SECRET', 'dev-secret-change-me'),
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('MYSQL_URL') or 'sqlite:///' + os.path.join(BASE_DIR, 'data.db'),  # sqlite: fallback dev only
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'MYSQL_REPLICA_URL': os.environ.get('MYSQL_REPLICA_URL'),  # opcional: réplica de lectura, ver @read_replica
+        # un hilo de gunicorn (WEB_THREADS = --threads) o de trabajos usa a lo más una conexión a la vez
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE') or int(os.environ.get('WEB_THREADS', '2')) + int(os.environ.get('JOBS_THREADS', '1'))),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', '2')),
+        'DB_POOL_TIMEOUT': int(os.environ.get('DB_POOL_TIMEOUT', '10')),  # seg. esperando una conexión libre
+        'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', '280')),  # seg.; menor que el wait_timeout de MySQL
+        'DB_POOL_PRE_PING': os.environ.get('DB_POOL_PRE_PING', '1') != '0',  # descarta conexiones muertas antes de usarlas
+        'SQLITE_BUSY_TIMEOUT': int(os.environ.get('SQLITE_BUSY_TIMEOUT', '15')),  # seg. esperando el lock de escritura
+        'UPLOAD_FOLDER': os.environ.get('UPLOAD_FOLDER', os.path.join(BASE_DIR, "uploads")),
+        # archivos de importación y exportaciones: fuera de UPLOAD_FOLDER, que /uploads sirve sin login
+        'PRIVATE_FOLDER': os.environ.get('PRIVATE_FOLDER', os.path.join(BASE_DIR, "private")),
+        'MAX_CONTENT_LENGTH': 100 * 1024 * 1024,  # 100MB por request
+        'UPLOAD_MAX_MB': int(os.environ.get('UPLOAD_MAX_MB', '100')),  # por archivo (videos, documentos)
+        'UPLOAD_MAX_IMAGE_MB': int(os.environ.get('UPLOAD_MAX_IMAGE_MB', '20')),
+        # '' = el worker envía los archivos; 'x-accel' (nginx) o 'x-sendfile' (apache) = los envía el proxy
+        'SENDFILE_MODE': os.environ.get('SENDFILE_MODE', ''),
+        'X_ACCEL_PREFIX': os.environ.get('X_ACCEL_PREFIX', '/_uploads/'),  # location internal de nginx con alias a uploads/
+        'SEARCH_INDEX': os.environ.get('SEARCH_INDEX', '1') != '0',  # 0 = volver al ilike
+        'SEARCH_INDEX_TTL': int(os.environ.get('SEARCH_INDEX_TTL', '300')),  # seg. entre reconstrucciones
+        'JOBS_RUNNER': os.environ.get('JOBS_RUNNER', '1') != '0',  # 0 = este proceso no ejecuta trabajos
+        'JOBS_THREADS': int(os.environ.get('JOBS_THREADS', '1')),  # hilos de trabajos por worker
+        'QUERY_BUDGET_STRICT': os.environ.get('QUERY_BUDGET_STRICT') == '1',  # 1 = error si una vista se pasa
+        'METRICS_DIR': os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'supermercado-metrics')),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),  # opcional: Authorization: Bearer <token> para el scraper
+        'SLOW_REQUEST_MS': int(os.environ.get('SLOW_REQUEST_MS', '1000')),
+        'CACHE_BACKEND': os.environ.get('CACHE_BACKEND', 'memory'),  # memory (por worker), sqlite (compartido), none
+        'CACHE_TTL': int(os.environ.get('CACHE_TTL', '300')),
+        'CACHE_SIZE': int(os.environ.get('CACHE_SIZE', '1024')),  # entradas del backend memory
+        'CACHE_PATH': os.environ.get('CACHE_PATH', os.path.join(tempfile.gettempdir(), 'supermercado-cache.sqlite')),
+        # cada cliente SSE ocupa un hilo de gunicorn mientras está conectado: como mucho estos por worker
+        'EVENTS_MAX_STREAMS': int(os.environ.get('EVENTS_MAX_STREAMS', '2')),
+        'EVENTS_STREAM_SECONDS': int(os.environ.get('EVENTS_STREAM_SECONDS', '300')),  # luego el navegador reconecta
+        'EVENTS_POLL': float(os.environ.get('EVENTS_POLL', '1')),  # seg. entre lecturas de order_event por worker
+    }
 
-MYSQL_URL = os.environ.get('MYSQL_URL')
-if MYSQL_URL:
-    app.config['SQLALCHEMY_DATABASE_URI'] = MYSQL_URL
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE_DIR, 'data.db')  # fallback dev only
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB
+class TimedQueuePool(QueuePool):
+    """QueuePool que mide la espera de cada checkout (si el pool se agota, la espera crece) para /metrics."""
+    def connect(self):
+        t0, label = time.perf_counter(), {'pool': self.logging_name or 'primaria'}
+        try:
+            return super().connect()
+        except PoolTimeout:
+            metrics.inc('db_pool_timeouts_total', label); raise
+        finally:
+            metrics.observe('db_pool_wait_seconds', label, time.perf_counter() - t0)
+
+def engine_options(config, url, name):
+    """Opciones del engine según DB_POOL_*; SQLite en memoria queda con el StaticPool de Flask-SQLAlchemy."""
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'): return {}
+    opts = {'poolclass': TimedQueuePool, 'pool_logging_name': name, 'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'], 'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'pool_recycle': config['DB_POOL_RECYCLE'], 'pool_pre_ping': config['DB_POOL_PRE_PING']}
+    if url.get_backend_name() == 'sqlite': opts['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT']}
+    return opts
+
+@event.listens_for(Engine, 'connect')
+def sqlite_wal(dbapi_conn, _):
+    # SQLite (dev): con WAL los lectores no bloquean al que escribe, como en MySQL
+    if isinstance(dbapi_conn, sqlite3.Connection): dbapi_conn.execute('PRAGMA journal_mode=WAL')
+
+class RoutingSession(FlaskSession):
+    """En las vistas marcadas con @read_replica los SELECT van a la réplica (bind 'replica', si existe);
+    escrituras, flush y el resto de las vistas usan la primaria."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and getattr(clause, 'is_select', False)
+                and has_app_context() and g.get('read_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
-db = SQLAlchemy(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+bp = Blueprint('main', __name__, cli_group=None)  # todas las rutas y comandos; se registra en create_app()
 
 # ---------------- Models ----------------
 class User(UserMixin, db.Model):
@@ -48,32 +122,53 @@ class Product(db.Model):
     image_url = db.Column(db.String(500), nullable=True)  # imagen del producto (URL)
     image_file = db.Column(db.String(255), nullable=True)  # imagen subida
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    stock = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # suma de ubicaciones, ver apply_stock_movements
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (db.Index('ix_product_created_id', 'created_at', 'id'),)  # paginación keyset de /inventario
 
 class ProductLocation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     tipo = db.Column(db.String(20), nullable=False)  # bodega, piso, trastienda
     pasillo = db.Column(db.String(50), nullable=True)
     rack = db.Column(db.String(50), nullable=True)
-    cantidad = db.Column(db.Integer, default=0)
+    cantidad = db.Column(db.Integer, default=0)  # total materializado de StockMovement de esta ubicación
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     product = db.relationship('Product', backref=db.backref('locations', lazy=True))
 
 class ProductLocationPhoto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    location_id = db.Column(db.Integer, db.ForeignKey('product_location.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('product_location.id'), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     location = db.relationship('ProductLocation', backref=db.backref('photos', lazy=True))
 
+class CatalogChange(db.Model):
+    """Un registro por producto modificado en cada transacción; el id es la secuencia de /api/catalogo/cambios
+    y lo asigna CatalogSeq (no el autoincrement), así sigue el orden de los commits."""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class CatalogSeq(db.Model):
+    """Fila única con el último id entregado a catalog_change. Se actualiza dentro de la transacción que
+    escribe los cambios y su lock dura hasta el commit: un id más alto nunca se hace visible antes que uno
+    más bajo (con el autoincrement sí, y un escáner que ya pidió desde=ese id se saltearía el menor)."""
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     requested_by = db.Column(db.String(120), nullable=False)  # nombre o email del solicitante
     requested_for_time = db.Column(db.String(50), nullable=True)  # hora deseada (select 8:00-20:30)
     status = db.Column(db.String(20), default='pendiente')  # pendiente, entregado
+    idempotency_key = db.Column(db.String(64), nullable=True, unique=True, index=True)  # un reintento no duplica la comanda
+    __table_args__ = (db.Index('ix_order_created_id', 'created_at', 'id'),
+                      db.Index('ix_order_status_created_id', 'status', 'created_at', 'id'))  # listado de /admin/comandas
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
     sku = db.Column(db.String(64), nullable=True)  # puede no existir en catálogo
     nombre = db.Column(db.String(200), nullable=False)
     cantidad = db.Column(db.Integer, nullable=False)
@@ -81,10 +176,31 @@ class OrderItem(db.Model):
 
 class OrderItemPhoto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_item_id = db.Column(db.Integer, db.ForeignKey('order_item.id'), nullable=False)
+    order_item_id = db.Column(db.Integer, db.ForeignKey('order_item.id'), nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     item = db.relationship('OrderItem', backref=db.backref('photos', lazy=True))
 
+class OrderEvent(db.Model):
+    """Eventos de comandas (creada, entregada) para el tablero en vivo; el id es el Last-Event-ID del SSE."""
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # creada, entregada
+    payload = db.Column(db.Text, nullable=False)  # JSON con la comanda y sus items
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class StockMovement(db.Model):
+    """Libro de movimientos de stock: solo se agregan filas, nunca se editan."""
+    id = db.Column(db.Integer, primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('product_location.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    order_item_id = db.Column(db.Integer, db.ForeignKey('order_item.id'), nullable=True, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # apertura, recepcion, entrega, ajuste, importacion
+    cantidad = db.Column(db.Integer, nullable=False)  # negativo = salida
+    created_by = db.Column(db.String(120), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    location = db.relationship('ProductLocation')
+    order_item = db.relationship('OrderItem', backref=db.backref('movements', lazy=True))
+
 class Planograma(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     titulo = db.Column(db.String(200), nullable=False)
@@ -103,6 +219,21 @@ class CursoMedia(db.Model):
     media_type = db.Column(db.String(20), nullable=False)
     curso = db.relationship('Curso', backref=db.backref('media', lazy=True))
 
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # import, image
+    status = db.Column(db.String(20), nullable=False, default='pendiente', index=True)  # pendiente, en_curso, ok, error
+    payload = db.Column(db.Text, nullable=True)  # JSON con los parámetros (y el avance guardado para reanudar)
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    progress = db.Column(db.Integer, nullable=False, default=0)  # 0-100
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String(64), nullable=True)  # host:pid que lo está ejecutando
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -116,12 +247,75 @@ def ensure_admin():
         admin.set_password(admin_pass)
         db.session.add(admin); db.session.commit()
 
-with app.app_context():
-    db.create_all(); ensure_admin()
+def ensure_indexes():
+    # create_all() no agrega índices nuevos a tablas que ya existen
+    for table in db.metadata.sorted_tables:
+        for ix in table.indexes: ix.create(db.engine, checkfirst=True)
+
+def ensure_columns():
+    """create_all() tampoco agrega columnas nuevas: las agrega con ALTER TABLE. Devuelve ['tabla.columna', ...]."""
+    insp, quote = db.inspect(db.engine), db.engine.dialect.identifier_preparer.quote
+    added = []
+    for table in db.metadata.sorted_tables:
+        if not insp.has_table(table.name): continue
+        have = {c['name'] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in have: continue
+            ddl = f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(col.name)} {col.type.compile(db.engine.dialect)}'
+            if col.server_default is not None: ddl += f' DEFAULT {col.server_default.arg}'
+            if not col.nullable: ddl += ' NOT NULL'
+            try:
+                with db.engine.begin() as conn: conn.execute(db.text(ddl))
+                added.append(f'{table.name}.{col.name}')
+            except Exception:  # otro worker la agregó al mismo tiempo
+                current_app.logger.warning('No se pudo agregar %s.%s', table.name, col.name, exc_info=True)
+    return added
 
 # Helpers
+class QueryBudgetExceeded(Exception):
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, *_):
+    conn.info['query_start'] = time.perf_counter()
+    if has_app_context(): g.sql_count = g.get('sql_count', 0) + 1
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, *_):
+    elapsed = time.perf_counter() - conn.info.pop('query_start', time.perf_counter())
+    if not has_app_context(): return
+    g.sql_time = g.get('sql_time', 0.0) + elapsed
+    slowest = g.setdefault('sql_slowest', [])  # las 3 más lentas, para el log de requests lentos
+    if len(slowest) < 3 or elapsed > slowest[-1][0]:
+        slowest.append((elapsed, statement)); slowest.sort(key=lambda x: -x[0]); del slowest[3:]
+
+def query_budget(limit):
+    """Máximo de statements SQL que puede ejecutar la vista (incluye cargar el usuario y el template).
+    Si se pasa se registra un warning, o se lanza QueryBudgetExceeded con QUERY_BUDGET_STRICT
+    (lo usa bench/query_budget.py para atrapar N+1)."""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorated(*args, **kwargs):
+            resp = fn(*args, **kwargs)
+            used = g.get('sql_count', 0)
+            if used > limit:
+                msg = f'{request.endpoint}: {used} queries SQL (presupuesto {limit})'
+                if current_app.config['QUERY_BUDGET_STRICT']: raise QueryBudgetExceeded(msg)
+                current_app.logger.warning(msg)
+            return resp
+        decorated.query_budget = limit
+        return decorated
+    return wrapper
+
+def read_replica(fn):
+    """Vista pública de solo lectura: sus consultas pueden ir a MYSQL_REPLICA_URL (con unos segundos de atraso)."""
+    @wraps(fn)
+    def decorated(*args, **kwargs):
+        g.read_replica = True
+        return fn(*args, **kwargs)
+    return decorated
+
 def role_required(*roles):
-    from functools import wraps
     def wrapper(fn):
         @wraps(fn)
         def decorated(*args, **kwargs):
@@ -133,56 +327,810 @@ def role_required(*roles):
         return decorated
     return wrapper
 
-def save_file(file_storage):
-    filename = secure_filename(file_storage.filename or '')
-    if not filename: return None
-    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file_storage.save(path)
+# ----------------- Métricas (formato Prometheus, sumadas entre workers) -----------------
+class Metrics:
+    """Contadores, gauges e histogramas en memoria de este proceso. Cada worker vuelca los suyos a
+    METRICS_DIR/<pid>.json (como mucho cada `flush_every` seg.) y /metrics suma los archivos de todos
+    los workers vivos, así el scraper ve el total del servidor aunque le conteste un solo worker."""
+    BUCKETS = {
+        'http_request_duration_seconds': (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+        'db_statements_per_request': (1, 2, 3, 5, 10, 20, 50, 100, 200),
+        'task_duration_seconds': (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+        'db_pool_wait_seconds': (.001, .005, .01, .05, .1, .5, 1, 2.5, 5, 10, 30),
+    }
+    HELP = {
+        'http_requests_total': 'Requests atendidos por endpoint, método y status',
+        'http_request_duration_seconds': 'Latencia por endpoint (hasta armar la respuesta)',
+        'db_statements_per_request': 'Statements SQL por request',
+        'db_statements_total': 'Statements SQL por endpoint',
+        'db_time_seconds_total': 'Tiempo en la base de datos por endpoint',
+        'slow_requests_total': 'Requests por sobre SLOW_REQUEST_MS',
+        'task_duration_seconds': 'Duración de tareas pesadas (Pillow, pandas)',
+        'import_rows_total': 'Filas procesadas por el importador',
+        'cache_requests_total': 'Lecturas del caché por tipo de entrada y resultado (hit/miss)',
+        'db_pool_wait_seconds': 'Espera para obtener una conexión del pool (incluye abrirla)',
+        'db_pool_timeouts_total': 'Requests que no obtuvieron conexión dentro de DB_POOL_TIMEOUT',
+        'db_pool_connections': 'Conexiones por pool y estado, sumadas entre workers',
+    }
+
+    def __init__(self, folder=None, flush_every=5):
+        self.folder, self.flush_every = folder, flush_every
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)   # (nombre, labels) -> valor
+        self.hists = {}                      # (nombre, labels) -> [conteo por bucket..., +Inf, suma]
+        self.gauges = {}                     # (nombre, labels) -> valor actual
+        self.collectors = []                 # funciones que actualizan gauges justo antes de volcar
+        self.flushed_at = 0
+
+    def init_app(self, app):
+        self.folder = app.config['METRICS_DIR']
+
+    def inc(self, name, labels, value=1):
+        with self.lock: self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, labels, value):
+        with self.lock: self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, labels, value):
+        buckets = self.BUCKETS[name]
+        with self.lock:
+            h = self.hists.setdefault((name, tuple(sorted(labels.items()))), [0] * (len(buckets) + 2))
+            h[bisect_left(buckets, value)] += 1
+            h[-1] += value
+
+    def flush(self, force=False):
+        if not force and time.time() - self.flushed_at < self.flush_every: return
+        self.flushed_at = time.time()
+        for collect in self.collectors: collect()
+        with self.lock:
+            data = {'counters': [[n, dict(l), v] for (n, l), v in self.counters.items()],
+                    'gauges': [[n, dict(l), v] for (n, l), v in self.gauges.items()],
+                    'hists': [[n, dict(l), h] for (n, l), h in self.hists.items()]}
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = os.path.join(self.folder, f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f: json.dump(data, f)
+        os.replace(tmp, os.path.join(self.folder, f'{os.getpid()}.json'))
+
+    def collect(self):
+        """Suma los archivos de todos los workers. Los contadores e histogramas de procesos que ya no
+        existen se pliegan en acumulado.json antes de borrar su archivo, así los totales nunca bajan
+        cuando gunicorn recicla un worker; sus gauges se descartan (ya no describen nada vivo)."""
+        def add(into, data, with_gauges=True):
+            counters, gauges, hists = into
+            for n, l, v in data.get('counters', []): counters[(n, tuple(sorted(l.items())))] += v
+            if with_gauges:
+                for n, l, v in data.get('gauges', []): gauges[(n, tuple(sorted(l.items())))] += v
+            for n, l, h in data.get('hists', []):
+                acc = hists.setdefault((n, tuple(sorted(l.items()))), [0] * len(h))
+                for i, x in enumerate(h): acc[i] += x
+        def load(path):
+            try:
+                with open(path) as f: return json.load(f)
+            except (OSError, ValueError):
+                return None
+        dump = lambda acc: {'counters': [[n, dict(l), v] for (n, l), v in acc[0].items()],
+                            'hists': [[n, dict(l), h] for (n, l), h in acc[2].items()]}
+        total = defaultdict(float), defaultdict(float), {}
+        if not os.path.isdir(self.folder): return total
+        # Todo bajo un lock exclusivo: si dos workers contestan /metrics a la vez, un muerto se
+        # pliega una sola vez y nadie suma el acumulado nuevo junto con el archivo ya plegado.
+        with open(os.path.join(self.folder, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            folded_path = os.path.join(self.folder, 'acumulado.json')
+            folded, dead = (defaultdict(float), {}, {}), []
+            add(folded, load(folded_path) or {}, with_gauges=False)
+            for fn in os.listdir(self.folder):
+                if not fn.endswith('.json') or not fn[:-5].isdigit(): continue
+                path = os.path.join(self.folder, fn)
+                data = load(path) or {}
+                try:
+                    os.kill(int(fn[:-5]), 0)
+                except ProcessLookupError:
+                    add(folded, data, with_gauges=False); dead.append(path); continue
+                except PermissionError:
+                    pass
+                add(total, data)
+            if dead:
+                tmp = folded_path + '.tmp'
+                with open(tmp, 'w') as f: json.dump(dump(folded), f)
+                os.replace(tmp, folded_path)
+                for path in dead: os.remove(path)
+        add(total, dump(folded))
+        return total
+
+    def render(self, counters, gauges, hists):
+        def fmt(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in pairs) + '}' if pairs else ''
+        out, typed = [], set()
+        def header(name, kind):
+            if name in typed: return
+            typed.add(name)
+            out.extend([f'# HELP {name} {self.HELP.get(name, name)}', f'# TYPE {name} {kind}'])
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for (n, l), v in sorted(values.items()):
+                header(n, kind); out.append(f'{n}{fmt(l)} {v:g}')
+        for (n, l), h in sorted(hists.items()):
+            header(n, 'histogram')
+            total = 0
+            for le, c in zip(list(self.BUCKETS[n]) + ['+Inf'], h[:-1]):
+                total += c; out.append(f'{n}_bucket{fmt(l, le=le)} {total:g}')
+            out += [f'{n}_sum{fmt(l)} {h[-1]:g}', f'{n}_count{fmt(l)} {total:g}']
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+
+def pool_gauges():
+    if not has_app_context(): return
+    for engine in db.engines.values():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool): continue
+        name = pool.logging_name or 'primaria'
+        for state, n in (('en_uso', pool.checkedout()), ('libres', pool.checkedin()), ('overflow', max(pool.overflow(), 0))):
+            metrics.set('db_pool_connections', {'pool': name, 'state': state}, n)
+
+metrics.collectors.append(pool_gauges)
+
+@contextmanager
+def timed(task):
+    t0 = time.perf_counter()
+    try: yield
+    finally: metrics.observe('task_duration_seconds', {'task': task}, time.perf_counter() - t0)
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_t0 = time.perf_counter()
+
+@bp.after_app_request
+def record_request(resp):
+    """Latencia, SQL y status por endpoint. En respuestas en streaming solo mide hasta el primer byte."""
+    if 'request_t0' not in g: return resp
+    elapsed = time.perf_counter() - g.request_t0
+    endpoint, sql = request.endpoint or 'sin_ruta', g.get('sql_count', 0)
+    metrics.inc('http_requests_total', {'endpoint': endpoint, 'method': request.method, 'status': resp.status_code})
+    metrics.observe('http_request_duration_seconds', {'endpoint': endpoint, 'method': request.method}, elapsed)
+    metrics.observe('db_statements_per_request', {'endpoint': endpoint}, sql)
+    metrics.inc('db_statements_total', {'endpoint': endpoint}, sql)
+    metrics.inc('db_time_seconds_total', {'endpoint': endpoint}, g.get('sql_time', 0.0))
+    if elapsed * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+        metrics.inc('slow_requests_total', {'endpoint': endpoint})
+        current_app.logger.warning('Request lento %s %s: %.0f ms, %d queries SQL (%.0f ms en la base)%s',
+                           request.method, request.full_path.rstrip('?'), elapsed * 1000, sql, g.get('sql_time', 0.0) * 1000,
+                           ''.join(f'\n  [{t * 1000:.0f} ms] {" ".join(st.split())[:500]}' for t, st in g.get('sql_slowest', [])))
+    try: metrics.flush()
+    except OSError: current_app.logger.warning('No se pudieron guardar las métricas', exc_info=True)
+    return resp
+
+@bp.route('/metrics')
+def metrics_view():
+    token = current_app.config['METRICS_TOKEN']
+    if not (token and request.headers.get('Authorization') == f'Bearer {token}'):
+        if not current_user.is_authenticated: return login_manager.unauthorized()
+        if current_user.role != 'admin': abort(403)
+    metrics.flush(force=True)
+    return current_app.response_class(metrics.render(*metrics.collect()), mimetype='text/plain; version=0.0.4')
+
+# ----------------- Caché de fragmentos (páginas públicas) -----------------
+class MemoryCache:
+    """LRU con TTL dentro del proceso. Cada worker tiene el suyo: una invalidación solo llega a los
+    demás workers cuando vence el TTL (para varios workers usar CACHE_BACKEND=sqlite)."""
+    def __init__(self, maxsize=1024):
+        self.maxsize, self.lock, self.data = maxsize, threading.Lock(), OrderedDict()  # key -> (expira, valor)
+
+    def get(self, key):
+        with self.lock:
+            hit = self.data.get(key)
+            if not hit: return None
+            if hit[0] < time.time():
+                del self.data[key]; return None
+            self.data.move_to_end(key)
+            return hit[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (time.time() + ttl, value); self.data.move_to_end(key)
+            while len(self.data) > self.maxsize: self.data.popitem(last=False)
+
+    def delete(self, keys, prefixes=()):
+        with self.lock:
+            for k in list(self.data):
+                if k in keys or k.startswith(tuple(prefixes)): del self.data[k]
+
+class SQLiteCache:
+    """Archivo SQLite compartido por todos los workers de la máquina (WAL: lecturas sin bloquear)."""
+    def __init__(self, path):
+        self.path, self.local = path, threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _conn(self):
+        if getattr(self.local, 'pid', None) != os.getpid():  # una conexión por hilo y por proceso (post-fork)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL'); conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return self.local.conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value FROM cache WHERE key = ? AND expires >= ?', (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        self._conn().execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+        if uuid.uuid4().int % 100 == 0:  # de vez en cuando limpia lo vencido
+            self._conn().execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+
+    def delete(self, keys, prefixes=()):
+        conn = self._conn()
+        conn.executemany('DELETE FROM cache WHERE key = ?', [(k,) for k in keys])
+        conn.executemany("DELETE FROM cache WHERE key >= ? AND key < ?", [(p, p + '\U0010ffff') for p in prefixes])
+
+class NullCache:
+    def get(self, key): return None
+    def set(self, key, value, ttl): pass
+    def delete(self, keys, prefixes=()): pass
+
+class Cache:
+    """Elige el backend según CACHE_BACKEND al registrarse en la app (como db y login_manager)."""
+    backend = NullCache()
+
+    def init_app(self, app):
+        backend = app.config['CACHE_BACKEND']
+        self.backend = (SQLiteCache(app.config['CACHE_PATH']) if backend == 'sqlite' else NullCache() if backend == 'none'
+                        else MemoryCache(app.config['CACHE_SIZE']))
+
+    def get(self, key): return self.backend.get(key)
+    def set(self, key, value, ttl): self.backend.set(key, value, ttl)
+    def delete(self, keys, prefixes=()): self.backend.delete(keys, prefixes)
+
+cache = Cache()
+
+def cached(key, compute, ttl=None):
+    """Valor de `key` ('tipo:id') o compute() guardado en el caché. Los valores se guardan como JSON
+    (así sirven para los dos backends y nadie modifica una entrada compartida). compute() lee de la
+    primaria aunque la vista sea @read_replica: justo después de una invalidación la réplica todavía
+    puede tener el dato viejo, y guardarlo lo dejaría servido hasta que venza el TTL."""
+    kind = key.split(':', 1)[0]
+    raw = cache.get(key)
+    metrics.inc('cache_requests_total', {'kind': kind, 'result': 'hit' if raw is not None else 'miss'})
+    if raw is not None: return json.loads(raw)
+    replica = g.pop('read_replica', None)
     try:
-        img = Image.open(path); img.thumbnail((1600,1600)); img.save(path)
-    except Exception: pass
+        value = compute()
+    finally:
+        if replica: g.read_replica = replica
+    cache.set(key, json.dumps(value, default=str), ttl or current_app.config['CACHE_TTL'])
+    return value
+
+def invalidate_on_commit(*keys):
+    """Borra esas entradas cuando la transacción actual haga commit ('producto:*' = todas las que
+    empiezan con 'producto:'). Si hay rollback no se borra nada."""
+    db.session.info.setdefault('cache_keys', set()).update(keys)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_cache(session):
+    keys = session.info.pop('cache_keys', None)
+    if not keys: return
+    try:
+        cache.delete({k for k in keys if not k.endswith('*')}, [k[:-1] for k in keys if k.endswith('*')])
+    except sqlite3.Error:
+        current_app.logger.warning('No se pudo invalidar el caché', exc_info=True)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_cache_keys(session):
+    session.info.pop('cache_keys', None)
+
+IMAGE_EXTS = {'jpg','jpeg','png','gif','webp','bmp'}
+VIDEO_EXTS = {'mp4','mov','webm'}
+DOC_EXTS = {'pdf','docx','xlsx','pptx'}
+IMAGE_SIZES = {'thumb': 200, 'medium': 800, 'full': 1600}  # lado mayor en px
+HASHED_NAME = re.compile(r'^[0-9a-f]{32}(\.[a-z0-9]+)?$')  # nombres inmutables generados por save_file
+
+def file_ext(filename):
+    return filename.rsplit('.',1)[-1].lower() if '.' in filename else ''
+
+class UploadRejected(ValueError):
+    pass
+
+def file_kind(ext):
+    return 'imagen' if ext in IMAGE_EXTS else 'video' if ext in VIDEO_EXTS else 'documento' if ext in DOC_EXTS else None
+
+def sniff_kind(head):
+    """Tipo real según los primeros bytes (no se confía en la extensión): imagen, video, documento o None."""
+    if head.startswith((b'\xff\xd8\xff', b'\x89PNG', b'GIF87a', b'GIF89a', b'BM')) or (head[:4] == b'RIFF' and head[8:12] == b'WEBP'):
+        return 'imagen'
+    if head[4:8] in (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip') or head.startswith(b'\x1aE\xdf\xa3'):
+        return 'video'
+    if head.startswith((b'%PDF', b'PK\x03\x04')):
+        return 'documento'
+    return None
+
+@timed('save_file')
+def save_file(file_storage, kinds=('imagen', 'video', 'documento')):
+    """Guarda el archivo con el hash de su contenido como nombre (dos 'IMG_0001.jpg' distintos ya no se
+    pisan y una foto repetida se guarda una sola vez). Se copia a disco de a 1 MB validando tipo (extensión
+    y primeros bytes) y tamaño; si no cumple lanza UploadRejected. Solo las imágenes pasan por Pillow, en
+    segundo plano, para generar las versiones reducidas."""
+    original = secure_filename(file_storage.filename or '')
+    if not original: return None
+    ext = file_ext(original)
+    kind = file_kind(ext)
+    if kind not in kinds: raise UploadRejected(f'{original}: tipo de archivo no permitido')
+    limit = current_app.config['UPLOAD_MAX_IMAGE_MB' if kind == 'imagen' else 'UPLOAD_MAX_MB'] * 1024 * 1024
+    folder = current_app.config['UPLOAD_FOLDER']
+    tmp = os.path.join(folder, f'.upload-{uuid.uuid4().hex}')
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, 'wb') as out:
+            for chunk in iter(lambda: file_storage.stream.read(1024 * 1024), b''):
+                if not size and sniff_kind(chunk[:16]) != kind:
+                    raise UploadRejected(f'{original}: el contenido no corresponde a un archivo .{ext}')
+                size += len(chunk)
+                if size > limit: raise UploadRejected(f'{original}: supera el máximo de {limit // 2**20} MB')
+                digest.update(chunk); out.write(chunk)
+        if not size: raise UploadRejected(f'{original}: archivo vacío')
+    except BaseException:
+        os.remove(tmp); raise
+    filename = digest.hexdigest()[:32] + (f'.{ext}' if ext else '')
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        os.remove(tmp)  # mismo contenido ya subido
+    else:
+        os.replace(tmp, path)
+    if kind == 'imagen' and not os.path.exists(derived_path(filename, 'thumb', 'webp')):
+        enqueue_job('image', commit=False, filename=filename)
     return filename
 
+@bp.app_errorhandler(UploadRejected)
+def upload_rejected(e):
+    db.session.rollback()
+    flash(str(e), 'danger')
+    # volver al formulario: rutas solo-POST (agregar ubicación) no se pueden recargar con GET
+    if request.url_rule and 'GET' in request.url_rule.methods: return redirect(request.url)
+    return redirect(request.referrer or url_for('main.home'))
+
+def derived_path(filename, size, fmt):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'derived', f"{filename.rsplit('.',1)[0]}_{size}.{fmt}")
+
+def derived_format(filename):
+    ext = file_ext(filename)
+    return 'jpg' if ext in ('jpg', 'jpeg') else 'webp' if ext == 'webp' else 'png'
+
+@timed('process_image')
+def process_image(filename):
+    """Genera thumb/medium/full en derived/ (en el formato original y en WebP). El original no se toca:
+    su nombre es el hash de su contenido y se sirve como immutable."""
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    os.makedirs(os.path.join(current_app.config['UPLOAD_FOLDER'], 'derived'), exist_ok=True)
+    from PIL import Image, ImageOps  # Pillow solo se carga en quien procesa imágenes
+    fmt = derived_format(filename)
+    with Image.open(path) as src:
+        img = ImageOps.exif_transpose(src)
+        img.load()
+    if fmt == 'jpg' and img.mode != 'RGB': img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA'): img = img.convert('RGBA')
+    opts = {'quality': 82, 'optimize': True} if fmt == 'jpg' else {}
+    for size, px in sorted(IMAGE_SIZES.items(), key=lambda kv: -kv[1]):
+        img.thumbnail((px, px))
+        img.save(derived_path(filename, size, 'webp'), 'WEBP', quality=80, method=4)
+        if fmt != 'webp': img.save(derived_path(filename, size, fmt), **opts)
+
+# ----------------- Índice de búsqueda (en memoria, por worker) -----------------
+def normalize_text(s):
+    """Minúsculas y sin acentos: 'Azúcar ÑANDÚ' -> 'azucar nandu'."""
+    s = unicodedata.normalize('NFKD', s or '')
+    return ''.join(c for c in s if not unicodedata.combining(c)).casefold().strip()
+
+def ngrams(s, n=3):
+    return {s[i:i+n] for i in range(len(s) - n + 1)}
+
+class SearchIndex:
+    """Índice de productos para /api/search, evita el ilike('%term%') (full scan) por cada tecla.
+
+    - nombre y sku completos, ordenados -> "empieza por"
+    - tokens (palabras del nombre + sku), ordenados -> prefijo de palabra
+    - trigramas de sku y nombre -> subcadena (lo que hacía el ilike)
+    - últimos 4 dígitos del sku -> ids
+    Todo normalizado con normalize_text. Se construye en un hilo aparte con el primer request del worker,
+    se actualiza al crear/editar/importar en este worker y se reconstruye cada `ttl` segundos (también en
+    segundo plano, uno a la vez) para recoger cambios hechos en otros workers.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.building = threading.Lock()  # lo tiene quien está reconstruyendo
+        self.built_at = None
+        self.docs = {}                  # id -> (sku_norm, nombre_norm)
+        self.heads = []                 # [(nombre|sku, id)] ordenada
+        self.tokens = []                # [(token, id)] ordenada
+        self.grams = defaultdict(set)   # trigrama -> ids
+        self.last4 = defaultdict(set)   # '1234' -> ids
+
+    @staticmethod
+    def _keys(sku, nombre):
+        heads = {nombre, sku}
+        toks = set(nombre.split()) | {sku}
+        l4 = sku[-4:] if len(sku) >= 4 and sku[-4:].isdigit() else None
+        return heads, toks, ngrams(sku) | ngrams(nombre), l4
+
+    def _put(self, pid, sku, nombre, append=False):
+        sku, nombre = normalize_text(sku), normalize_text(nombre)
+        heads, toks, grams, l4 = self._keys(sku, nombre)
+        self.docs[pid] = (sku, nombre)
+        for key, lst in ((heads, self.heads), (toks, self.tokens)):
+            for k in key:
+                if append: lst.append((k, pid))
+                else: insort(lst, (k, pid))
+        for g in grams: self.grams[g].add(pid)
+        if l4: self.last4[l4].add(pid)
+
+    def _remove(self, pid):
+        doc = self.docs.pop(pid, None)
+        if not doc: return
+        heads, toks, grams, l4 = self._keys(*doc)
+        for key, lst in ((heads, self.heads), (toks, self.tokens)):
+            for k in key:
+                i = bisect_left(lst, (k, pid))
+                if i < len(lst) and lst[i] == (k, pid): del lst[i]
+        for g in grams: self.grams[g].discard(pid)
+        if l4: self.last4[l4].discard(pid)
+
+    def rebuild(self):
+        rows = db.session.query(Product.id, Product.sku, Product.nombre).all()
+        fresh = SearchIndex(self.ttl)
+        for pid, sku, nombre in rows: fresh._put(pid, sku, nombre, append=True)
+        fresh.heads.sort(); fresh.tokens.sort()
+        with self.lock:
+            self.docs, self.heads, self.tokens = fresh.docs, fresh.heads, fresh.tokens
+            self.grams, self.last4 = fresh.grams, fresh.last4
+            self.built_at = time.monotonic()
+
+    def refresh(self, app):
+        """Reconstruye en otro hilo si nadie lo está haciendo; mientras tanto las búsquedas usan el índice actual."""
+        if not self.building.acquire(blocking=False): return
+        def run():
+            try:
+                with app.app_context(): self.rebuild()
+            except Exception:
+                app.logger.exception('No se pudo reconstruir el índice de búsqueda')
+            finally:
+                self.building.release()
+        threading.Thread(target=run, name='search-index', daemon=True).start()
+
+    def upsert(self, p):
+        with self.lock:
+            self._remove(p.id); self._put(p.id, p.sku, p.nombre)
+
+    @staticmethod
+    def _prefix(lst, word, exact=False):
+        lo = bisect_left(lst, (word,))
+        hi = bisect_left(lst, (word + ('\x00' if exact else '\uffff'),))
+        return (lst[i][1] for i in range(lo, hi))
+
+    def _tiers(self, q):
+        """Candidatos por orden de relevancia; cada nivel se evalúa solo si los anteriores no llenan el límite."""
+        docs, words = self.docs, q.split()
+        yield (pid for pid in self._prefix(self.heads, q, exact=True) if docs[pid][0] == q)   # sku exacto
+        if len(q) == 4 and q.isdigit(): yield sorted(self.last4.get(q, ()))          # últimos 4
+        yield self._prefix(self.heads, q)                                            # nombre/sku empieza por
+        if len(words) == 1:
+            yield self._prefix(self.tokens, q)                                       # alguna palabra empieza por
+        else:
+            sets = sorted((set(self._prefix(self.tokens, w)) for w in words), key=len)
+            yield sorted(set.intersection(*sets), key=lambda pid: docs[pid][1])
+        if len(q) >= 3:                                                              # subcadena (ilike)
+            postings = sorted((self.grams.get(g, set()) for g in ngrams(q)), key=len)
+            hits = (pid for pid in set.intersection(*postings) if q in docs[pid][0] or q in docs[pid][1])
+            yield sorted(hits, key=lambda pid: docs[pid][1])
+
+    def search(self, term, limit=12):
+        q = normalize_text(term)
+        if not q: return []
+        if self.built_at is None:
+            with self.building:  # sin índice todavía: espera al que lo está armando o lo arma
+                if self.built_at is None: self.rebuild()
+        elif time.monotonic() - self.built_at > self.ttl:
+            self.refresh(current_app._get_current_object())
+        out, seen = [], set()
+        with self.lock:
+            for tier in self._tiers(q):
+                for pid in tier:
+                    if pid in seen: continue
+                    seen.add(pid); out.append(pid)
+                    if len(out) >= limit: return out
+        return out
+
+search_index = SearchIndex()
+
+@bp.before_app_request
+def warm_search_index():
+    if current_app.config['SEARCH_INDEX'] and search_index.built_at is None:
+        search_index.refresh(current_app._get_current_object())
+
+# ----------------- Trabajos en segundo plano -----------------
+JOB_HANDLERS = {}
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"  # en cada llamada: con --preload el pid cambia tras el fork
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn; return fn
+    return register
+
+def enqueue_job(kind, commit=True, **payload):
+    """Con commit=False el trabajo queda en la transacción del que llama: se guarda (y se despierta el
+    runner) solo si esa transacción hace commit."""
+    job = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(job)
+    if commit:
+        db.session.commit(); job_runner.wake()
+    else:
+        db.session.info['wake_jobs'] = True
+    return job
+
+@event.listens_for(db.session, 'after_commit')
+def wake_job_runner(session):
+    if session.info.pop('wake_jobs', False): job_runner.wake()
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_wake(session):
+    session.info.pop('wake_jobs', None)
+
+def job_json(job):
+    return {"id": job.id, "kind": job.kind, "status": job.status, "progress": job.progress,
+            "result": json.loads(job.result) if job.result else None, "error": job.error,
+            "created_at": job.created_at.isoformat() if job.created_at else None,
+            "finished_at": job.finished_at.isoformat() if job.finished_at else None}
+
+class JobRunner:
+    """Ejecuta los trabajos de la tabla `job` en hilos propios de cada worker (sin broker externo).
+
+    Cada worker de gunicorn arranca su runner con el primer request; el UPDATE ... WHERE status='pendiente'
+    garantiza que un trabajo lo toma un solo worker. Si un worker muere, su trabajo deja de latir y a los
+    `stale` segundos vuelve a la cola (hasta `max_attempts` intentos); los handlers reanudan desde el
+    avance guardado en el payload.
+    """
+    def __init__(self, threads=1, poll=2.0, stale=300, max_attempts=3):
+        self.threads, self.poll, self.stale, self.max_attempts = threads, poll, stale, max_attempts
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.app = None
+        self.requeued_at = None  # último requeue_stale de este worker (monotonic)
+
+    def start(self, app):
+        if self.started: return
+        with self.lock:
+            if self.started: return
+            self.app = app
+            for i in range(self.threads):
+                threading.Thread(target=self._loop, name=f'jobs-{i}', daemon=True).start()
+            self.started = True
+
+    def wake(self):
+        self.event.set()
+
+    def _loop(self):
+        while True:
+            job_id = None
+            with self.app.app_context():
+                try:
+                    job_id = self.claim()
+                    if job_id: self.run(job_id)
+                except Exception:
+                    current_app.logger.exception('Error en el runner de trabajos')
+                    db.session.rollback()
+            if not job_id:
+                self.event.wait(self.poll); self.event.clear()
+
+    def requeue_stale(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale)
+        stale = Job.query.filter(Job.status == 'en_curso', Job.heartbeat_at < cutoff)
+        stale.filter(Job.attempts >= self.max_attempts).update(
+            {'status': 'error', 'error': 'El worker se detuvo demasiadas veces', 'finished_at': datetime.utcnow()},
+            synchronize_session=False)
+        stale.update({'status': 'pendiente', 'worker': None}, synchronize_session=False)
+        db.session.commit()
+
+    def claim(self):
+        # los trabajos huérfanos tardan `stale` seg. en vencer: revisarlos más seguido solo escribe en la primaria
+        with self.lock:
+            due = self.requeued_at is None or time.monotonic() - self.requeued_at >= self.stale
+            if due: self.requeued_at = time.monotonic()
+        if due: self.requeue_stale()
+        row = db.session.query(Job.id).filter_by(status='pendiente').order_by(Job.id).first()
+        if not row: return None
+        now = datetime.utcnow()
+        taken = Job.query.filter_by(id=row.id, status='pendiente').update(
+            {'status': 'en_curso', 'worker': worker_id(), 'started_at': now, 'heartbeat_at': now,
+             'attempts': Job.attempts + 1}, synchronize_session=False)
+        db.session.commit()
+        return row.id if taken else None
+
+    def run(self, job_id):
+        job = db.session.get(Job, job_id)
+        def progress(pct):
+            job.progress = max(0, min(int(pct), 99)); job.heartbeat_at = datetime.utcnow()
+            db.session.commit()
+        try:
+            result = JOB_HANDLERS[job.kind](job, progress)
+            job.status, job.progress = 'ok', 100
+            job.result = json.dumps(result) if result is not None else job.result
+        except Exception as e:
+            current_app.logger.exception('Trabajo %s falló', job_id)
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status, job.error = 'error', str(e)
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    def run_pending(self):
+        """Ejecuta en el hilo actual todo lo pendiente (para scripts y pruebas; requiere app context)."""
+        while (job_id := self.claim()): self.run(job_id)
+
+job_runner = JobRunner()
+
+@bp.before_app_request
+def start_job_runner():
+    # se arranca en el primer request y no al importar: así cada worker (post-fork) tiene sus hilos
+    if current_app.config['JOBS_RUNNER'] and not job_runner.started:
+        job_runner.threads = current_app.config['JOBS_THREADS']
+        job_runner.start(current_app._get_current_object())
+
+@job_handler('image')
+def run_image_job(job, progress):
+    process_image(json.loads(job.payload)['filename'])
+
+@bp.route('/api/jobs/<int:job_id>')
+@login_required
+@role_required('admin','bodeguero')
+def api_job(job_id):
+    return jsonify(job_json(Job.query.get_or_404(job_id)))
+
+@bp.cli.command('imagenes')
+def regenerar_imagenes():
+    """Genera las versiones reducidas de las imágenes subidas antes de que existieran (flask --app app imagenes)."""
+    folder = current_app.config['UPLOAD_FOLDER']
+    for fn in sorted(os.listdir(folder)):
+        if file_ext(fn) in IMAGE_EXTS and os.path.isfile(os.path.join(folder, fn)):
+            try: process_image(fn); print('ok', fn)
+            except Exception as e: print('error', fn, e)
+
 # Files
-@app.route('/uploads/<path:filename>')
+@bp.app_template_global()
+def media_url(filename, size='full'):
+    return url_for('main.uploaded_file', filename=filename, size=size if size != 'full' else None)
+
+@bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """?size=thumb|medium|full elige la versión reducida (WebP si el navegador lo acepta). Los archivos con
+    nombre por hash nunca cambian: se cachean un año como immutable. send_from_directory ya responde
+    Range (206, para adelantar videos) y condicionales (304); con SENDFILE_MODE los bytes los envía el
+    proxy y el worker queda libre apenas arma los headers."""
+    folder = current_app.config['UPLOAD_FOLDER']
+    immutable = bool(HASHED_NAME.match(filename))
+    max_age = 365 * 24 * 3600 if immutable else 3600
+    name = filename
+    if file_ext(filename) in IMAGE_EXTS:
+        size = request.args.get('size', 'full')
+        size = size if size in IMAGE_SIZES else 'full'
+        candidates = ['webp'] if 'image/webp' in request.headers.get('Accept', '') else []
+        candidates.append(derived_format(filename))
+        for fmt in candidates:
+            p = derived_path(filename, size, fmt)
+            if os.path.exists(p):
+                name = os.path.relpath(p, folder); break
+        else:
+            # la versión reducida todavía no existe: el original se sirve sin immutable y con caché corto
+            immutable, max_age = False, 60
+    if current_app.config['SENDFILE_MODE'] == 'x-accel':
+        path = safe_join(folder, name)
+        if not path or not os.path.isfile(path): abort(404)
+        resp = current_app.response_class(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        resp.headers['X-Accel-Redirect'] = current_app.config['X_ACCEL_PREFIX'].rstrip('/') + '/' + quote(name)
+        resp.cache_control.public, resp.cache_control.max_age = True, max_age
+    else:
+        resp = send_from_directory(folder, name, max_age=max_age)
+    if file_ext(filename) in IMAGE_EXTS: resp.vary.add('Accept')
+    if immutable: resp.cache_control.immutable = True
+    return resp
 
 # ----------------- Public pages -----------------
-@app.route('/')
+@bp.route('/')
+@query_budget(3)
+@read_replica
 def home():
-    pasillos = db.session.query(ProductLocation.pasillo).distinct().all()
-    pasillos = sorted([p[0] for p in pasillos if p[0]])
-    planograma = Planograma.query.first()
-    return render_template('home.html', pasillos=pasillos, planograma=planograma)
+    def load_pasillos():
+        return sorted(p for p, in db.session.query(ProductLocation.pasillo).distinct() if p)
+    def load_planograma():
+        p = Planograma.query.first()
+        return {'titulo': p.titulo, 'contenido': p.contenido} if p else None
+    return render_template('home.html', pasillos=cached('pasillos', load_pasillos),
+                           planograma=cached('planograma', load_planograma))
 
 # Login/Logout
-@app.route('/login', methods=['GET','POST'])
+@bp.route('/login', methods=['GET','POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email','').strip().lower()
         password = request.form.get('password','')
         user = User.query.filter_by(email=email).first()
         if user and user.check_password(password):
-            login_user(user); return redirect(url_for('home'))
+            login_user(user); return redirect(url_for('main.home'))
         flash('Credenciales inválidas', 'danger')
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # ----------------- Inventario -----------------
-@app.route('/inventario')
+INVENTARIO_PAGE = 50
+
+def encode_cursor(p):
+    return f"{p.created_at.isoformat()}_{p.id}"
+
+def decode_cursor(cursor):
+    try:
+        ts, pid = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(ts), int(pid)
+    except (AttributeError, ValueError):
+        return None
+
+def inventario_page(after=None, categoria=None, pasillo=None, limit=INVENTARIO_PAGE):
+    """Una página del inventario (más recientes primero) como [(Product, stock)] + cursor de la siguiente.
+
+    Keyset sobre (created_at, id) en vez de OFFSET y el stock materializado en Product.stock: el costo
+    no crece con el tamaño del catálogo.
+    """
+    q = db.session.query(Product, Product.stock)
+    if categoria: q = q.filter(Product.categoria == categoria)
+    if pasillo:
+        q = q.filter(db.select(ProductLocation.id).where(ProductLocation.product_id == Product.id,
+                                                         ProductLocation.pasillo == pasillo).exists())
+    if after:
+        ts, pid = after
+        q = q.filter(db.or_(Product.created_at < ts, db.and_(Product.created_at == ts, Product.id < pid)))
+    rows = q.order_by(Product.created_at.desc(), Product.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1][0]) if len(rows) > limit else None
+    return [(p, int(s)) for p, s in rows[:limit]], next_cursor
+
+def inventario_args():
+    cursor = request.args.get('cursor', '').strip()
+    after = decode_cursor(cursor) if cursor else None
+    filtros = {k: request.args.get(k, '').strip() or None for k in ('categoria', 'pasillo')}
+    return cursor, after, filtros
+
+@bp.route('/inventario')
+@query_budget(2)
 @login_required
 def inventario():
-    productos = Product.query.order_by(Product.created_at.desc()).all()
-    stock_map = {p.id: sum(loc.cantidad for loc in p.locations) for p in productos}
-    return render_template('inventario.html', productos=productos, stock_map=stock_map)
+    cursor, after, filtros = inventario_args()
+    rows, next_cursor = inventario_page(after, **filtros)
+    productos = [p for p, _ in rows]
+    stock_map = {p.id: s for p, s in rows}
+    return render_template('inventario.html', productos=productos, stock_map=stock_map,
+                           next_cursor=next_cursor, filtros=filtros, paginado=bool(cursor))
+
+@bp.route('/api/inventario')
+@query_budget(2)
+@login_required
+def api_inventario():
+    cursor, after, filtros = inventario_args()
+    if cursor and not after:
+        return jsonify({"error": "cursor inválido"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', INVENTARIO_PAGE)), 1), 500)
+    except ValueError:
+        limit = INVENTARIO_PAGE
+    rows, next_cursor = inventario_page(after, limit=limit, **filtros)
+    items = [{"id": p.id, "sku": p.sku, "nombre": p.nombre, "categoria": p.categoria, "stock": s} for p, s in rows]
+    return jsonify({"items": items, "next_cursor": next_cursor})
 
-@app.route('/producto/nuevo', methods=['GET','POST'])
+@bp.route('/producto/nuevo', methods=['GET','POST'])
 @login_required
 @role_required('admin','bodeguero')
 def producto_nuevo():
@@ -200,14 +1148,15 @@ def producto_nuevo():
         p = Product(sku=sku, nombre=nombre, categoria=categoria, comentarios=comentarios)
         if image_url: p.image_url = image_url
         if image_file_upload and image_file_upload.filename:
-            fn = save_file(image_file_upload); 
+            fn = save_file(image_file_upload, kinds=('imagen',))
             if fn: p.image_file = fn
         db.session.add(p); db.session.commit()
+        search_index.upsert(p)
         flash('Producto creado. Ahora agrega ubicaciones y fotos por área.', 'success')
-        return redirect(url_for('producto_editar', product_id=p.id))
+        return redirect(url_for('main.producto_editar', product_id=p.id))
     return render_template('producto_form.html', producto=None)
 
-@app.route('/producto/<int:product_id>/editar', methods=['GET','POST'])
+@bp.route('/producto/<int:product_id>/editar', methods=['GET','POST'])
 @login_required
 @role_required('admin','bodeguero')
 def producto_editar(product_id):
@@ -220,13 +1169,15 @@ def producto_editar(product_id):
         if image_url: p.image_url = image_url
         image_file_upload = request.files.get('image_file')
         if image_file_upload and image_file_upload.filename:
-            fn = save_file(image_file_upload); 
+            fn = save_file(image_file_upload, kinds=('imagen',))
             if fn: p.image_file = fn
+        invalidate_on_commit(f'producto:{p.id}')
         db.session.commit()
+        search_index.upsert(p)
         flash('Producto actualizado', 'success')
     return render_template('producto_form.html', producto=p)
 
-@app.route('/producto/<int:product_id>/ubicacion/agregar', methods=['POST'])
+@bp.route('/producto/<int:product_id>/ubicacion/agregar', methods=['POST'])
 @login_required
 @role_required('admin','bodeguero')
 def producto_agregar_ubicacion(product_id):
@@ -235,45 +1186,75 @@ def producto_agregar_ubicacion(product_id):
     pasillo = request.form.get('pasillo')
     rack = request.form.get('rack')
     cantidad = int(request.form.get('cantidad') or 0)
-    loc = ProductLocation(product=p, tipo=tipo, pasillo=pasillo, rack=rack, cantidad=cantidad)
-    db.session.add(loc); db.session.commit()
-    for f in request.files.getlist('fotos_area'):
-        fn = save_file(f)
-        if fn: db.session.add(ProductLocationPhoto(location=loc, filename=fn))
+    # las fotos se validan antes de escribir nada: si alguna se rechaza no queda la ubicación ni su stock
+    fotos = [fn for fn in (save_file(f, kinds=('imagen',)) for f in request.files.getlist('fotos_area')) if fn]
+    loc = ProductLocation(product=p, tipo=tipo, pasillo=pasillo, rack=rack, cantidad=0)
+    db.session.add(loc); db.session.flush()
+    db.session.add_all(ProductLocationPhoto(location=loc, filename=fn) for fn in fotos)
+    invalidate_on_commit(f'producto:{p.id}', 'pasillos')
+    if cantidad:
+        apply_stock_movements([StockMovement(location_id=loc.id, product_id=p.id, kind='recepcion',
+                                             cantidad=cantidad, created_by=current_user.email)])
     db.session.commit()
     flash('Ubicación agregada', 'success')
-    return redirect(url_for('producto_editar', product_id=p.id))
+    return redirect(url_for('main.producto_editar', product_id=p.id))
 
-@app.route('/producto/<int:product_id>')
+@bp.route('/producto/<int:product_id>')
+@query_budget(4)
+@read_replica
 def producto_detalle(product_id):
-    p = Product.query.get_or_404(product_id)
-    stock_total = sum(loc.cantidad for loc in p.locations)
-    return render_template('producto_detalle.html', p=p, stock_total=stock_total)
+    def load():
+        p = (Product.query.options(selectinload(Product.locations).selectinload(ProductLocation.photos))
+             .filter_by(id=product_id).first_or_404())
+        return {'id': p.id, 'sku': p.sku, 'nombre': p.nombre, 'comentarios': p.comentarios, 'stock': p.stock,
+                'image_url': p.image_url, 'image_file': p.image_file,
+                'locations': [{'tipo': l.tipo, 'pasillo': l.pasillo, 'rack': l.rack, 'cantidad': l.cantidad,
+                               'photos': [{'filename': ph.filename} for ph in l.photos]} for l in p.locations]}
+    p = cached(f'producto:{product_id}', load)
+    return render_template('producto_detalle.html', p=p, stock_total=p['stock'])
 
 # ----------------- Buscador (público) -----------------
-@app.route('/buscar')
+@bp.route('/buscar')
 def buscar():
     return render_template('buscar.html')
 
-@app.route('/api/search')
-def api_search():
-    term = request.args.get('q','').strip()
-    if not term: return jsonify([])
+def search_ilike(term, limit=12):
+    """Búsqueda original (full scan por el comodín inicial). Se usa si SEARCH_INDEX=0 y como referencia en bench/."""
     filt = db.or_(Product.nombre.ilike(f'%{term}%'), Product.sku.ilike(f'%{term}%'))
     if len(term) == 4 and term.isdigit():
         filt = db.or_(filt, Product.sku.ilike(f'%{term}'))  # últimos 4
-    products = Product.query.filter(filt).limit(12).all()
-    data = []
-    for p in products:
-        stock = sum(loc.cantidad for loc in p.locations)
-        loc = next((l for t in ['piso','trastienda','bodega'] for l in p.locations if l.tipo==t), None)
-        pasillo = loc.pasillo if loc else None
-        rack = loc.rack if loc else None
-        foto_area = None
-        if loc and loc.photos: foto_area = url_for('uploaded_file', filename=loc.photos[0].filename)
-        prod_img = p.image_url or (url_for('uploaded_file', filename=p.image_file) if p.image_file else None)
-        data.append({"id": p.id, "sku": p.sku, "nombre": p.nombre, "stock": stock, "pasillo": pasillo, "rack": rack, "foto_area": foto_area, "foto_producto": prod_img})
-    return jsonify(data)
+    return Product.query.filter(filt).limit(limit).all()
+
+def search_products(term, limit=12):
+    """Productos para el autocompletado, con ubicaciones y fotos cargadas en 2 queries extra (sin lazy-load por fila)."""
+    if not current_app.config['SEARCH_INDEX']:
+        return search_ilike(term, limit)
+    ids = search_index.search(term, limit)
+    if not ids: return []
+    products = (Product.query.filter(Product.id.in_(ids))
+                .options(selectinload(Product.locations).selectinload(ProductLocation.photos)).all())
+    by_id = {p.id: p for p in products}
+    return [by_id[i] for i in ids if i in by_id]
+
+PRIMARY_LOC = ['piso','trastienda','bodega']  # ubicación que se muestra primero (buscador, catálogo de escáneres)
+
+def search_payload(p):
+    stock = p.stock
+    loc = next((l for t in PRIMARY_LOC for l in p.locations if l.tipo==t), None)
+    pasillo = loc.pasillo if loc else None
+    rack = loc.rack if loc else None
+    foto_area = None
+    if loc and loc.photos: foto_area = media_url(loc.photos[0].filename, 'medium')
+    prod_img = p.image_url or (media_url(p.image_file, 'thumb') if p.image_file else None)
+    return {"id": p.id, "sku": p.sku, "nombre": p.nombre, "stock": stock, "pasillo": pasillo, "rack": rack, "foto_area": foto_area, "foto_producto": prod_img}
+
+@bp.route('/api/search')
+@query_budget(3)
+@read_replica
+def api_search():
+    term = request.args.get('q','').strip()
+    if not term: return jsonify([])
+    return jsonify([search_payload(p) for p in search_products(term)])
 
 # ----------------- Comandas -----------------
 def time_slots():
@@ -282,144 +1263,915 @@ def time_slots():
         slots.append(f"{h:02d}:00"); slots.append(f"{h:02d}:30")
     return slots
 
-@app.route('/comanda/nueva', methods=['GET','POST'])
+def validate_order_items(items):
+    """Valida todas las filas antes de escribir nada; los SKUs se buscan en el catálogo con una sola query
+    (completa el nombre si viene vacío). Devuelve (items normalizados, errores)."""
+    rows, errors = [], []
+    for n, it in enumerate(items if isinstance(items, list) else [], 1):
+        if not isinstance(it, dict): errors.append((n, 'formato inválido')); continue
+        sku = str(it.get('sku') or '').strip() or None
+        nombre = str(it.get('nombre') or '').strip()
+        try:
+            cantidad = int(it.get('cantidad', 1))
+        except (TypeError, ValueError):
+            cantidad = 0
+        if cantidad < 1: errors.append((n, 'cantidad inválida'))
+        if sku and len(sku) > 64: errors.append((n, 'SKU demasiado largo'))
+        rows.append({'n': n, 'sku': sku, 'nombre': nombre[:200], 'cantidad': cantidad,
+                     'photo_fields': [f for f in it.get('photo_fields') or [] if isinstance(f, str)]})
+    skus = {r['sku'] for r in rows if r['sku'] and not r['nombre']}
+    catalog = dict(db.session.query(Product.sku, Product.nombre).filter(Product.sku.in_(skus))) if skus else {}
+    for r in rows:
+        r['nombre'] = r['nombre'] or catalog.get(r['sku'], '')
+        if not r['nombre']:
+            errors.append((r['n'], 'falta el nombre' + (f" (SKU {r['sku']} no está en el catálogo)" if r['sku'] else '')))
+    errors = [f'Producto {n}: {msg}' for n, msg in sorted(errors)]
+    if not rows and not errors: errors.append('Agrega al menos un producto')
+    return rows, errors
+
+@bp.route('/comanda/nueva', methods=['GET','POST'])
 def comanda_nueva():
+    """Crea la comanda, sus items y fotos en una sola transacción. El formulario trae una clave de
+    idempotencia (o el header Idempotency-Key): un doble toque o un reintento devuelve la comanda original."""
     if request.method == 'POST':
+        key = (request.headers.get('Idempotency-Key') or request.form.get('idempotency_key', '')).strip()[:64] or None
+        prev = Order.query.filter_by(idempotency_key=key).first() if key else None
+        if prev:
+            flash('Esa comanda ya estaba registrada.', 'info')
+            return redirect(url_for('main.comanda_ver', order_id=prev.id))
         requested_by = request.form.get('requested_by','').strip() or 'anonimo'
         requested_for_time = request.form.get('requested_for_time','')
-        items_raw = request.form.get('items_json','[]')
         try:
-            items = json.loads(items_raw)
-        except Exception:
+            items = json.loads(request.form.get('items_json','[]'))
+        except ValueError:
             items = []
-        if not items:
-            flash('Agrega al menos un producto', 'danger'); return redirect(request.url)
-        order = Order(requested_by=requested_by, requested_for_time=requested_for_time, status='pendiente')
-        db.session.add(order); db.session.commit()
+        items, errors = validate_order_items(items)
+        if errors:
+            flash('; '.join(errors), 'danger'); return redirect(request.url)
+        order = Order(requested_by=requested_by, requested_for_time=requested_for_time, status='pendiente',
+                      idempotency_key=key)
         for it in items:
-            oi = OrderItem(order=order, sku=it.get('sku'), nombre=it.get('nombre'), cantidad=int(it.get('cantidad',1)))
-            db.session.add(oi); db.session.commit()
-            for field_name in it.get('photo_fields', []):
+            oi = OrderItem(order=order, sku=it['sku'], nombre=it['nombre'], cantidad=it['cantidad'])
+            for field_name in it['photo_fields']:
                 fs = request.files.get(field_name)
                 if fs and fs.filename:
-                    fn = save_file(fs); 
-                    if fn: db.session.add(OrderItemPhoto(order_item_id=oi.id, filename=fn))
-        db.session.commit()
+                    fn = save_file(fs, kinds=('imagen',))  # las versiones reducidas se generan después del commit
+                    if fn: oi.photos.append(OrderItemPhoto(filename=fn))
+        db.session.add(order)
+        try:
+            db.session.flush()
+            record_order_event(order, 'creada', order.items)
+            db.session.commit()
+        except IntegrityError:
+            # otro request con la misma clave se adelantó
+            db.session.rollback()
+            prev = Order.query.filter_by(idempotency_key=key).first() if key else None
+            if not prev: raise
+            flash('Esa comanda ya estaba registrada.', 'info')
+            return redirect(url_for('main.comanda_ver', order_id=prev.id))
         flash('Comanda creada. Quedará PENDIENTE hasta que bodega la entregue.', 'success')
-        return redirect(url_for('comanda_ver', order_id=order.id))
-    return render_template('comanda_nueva.html', time_slots=time_slots())
+        return redirect(url_for('main.comanda_ver', order_id=order.id))
+    return render_template('comanda_nueva.html', time_slots=time_slots(), idempotency_key=uuid.uuid4().hex)
 
-@app.route('/comanda/<int:order_id>')
+@bp.route('/comanda/<int:order_id>')
+@query_budget(7)
 @login_required
 def comanda_ver(order_id):
-    o = Order.query.get_or_404(order_id)
+    o = (Order.query.options(selectinload(Order.items).selectinload(OrderItem.photos))
+         .filter_by(id=order_id).first_or_404())
     if not (current_user.role in ['admin','bodeguero'] or current_user.email == o.requested_by):
         abort(403)
+    skus = {it.sku for it in o.items if it.sku}
+    products = (Product.query.filter(Product.sku.in_(skus))
+                .options(selectinload(Product.locations).selectinload(ProductLocation.photos)).all()) if skus else []
+    by_sku = {p.sku: p for p in products}
     enriched = []
     for it in o.items:
-        p = Product.query.filter_by(sku=it.sku).first() if it.sku else None
+        p = by_sku.get(it.sku)
         foto = None
         if p:
             loc = next((l for l in p.locations if l.tipo in ['piso','trastienda']), None)
-            if loc and loc.photos: foto = url_for('uploaded_file', filename=loc.photos[0].filename)
+            if loc and loc.photos: foto = media_url(loc.photos[0].filename, 'thumb')
         enriched.append((it, foto))
     return render_template('comanda_detalle.html', order=o, items=enriched)
 
-@app.route('/admin/comandas')
+COMANDAS_PAGE = 30
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+@bp.route('/admin/comandas')
+@query_budget(4)
 @login_required
 @role_required('admin','bodeguero')
 def admin_comandas():
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin_comandas.html', orders=orders)
+    filtros = {'status': request.args.get('status', '').strip() or None,
+               'desde': request.args.get('desde', '').strip() or None,
+               'hasta': request.args.get('hasta', '').strip() or None}
+    q = Order.query.options(selectinload(Order.items))
+    if filtros['status']: q = q.filter(Order.status == filtros['status'])
+    desde, hasta = parse_date(filtros['desde']), parse_date(filtros['hasta'])
+    if desde: q = q.filter(Order.created_at >= desde)
+    if hasta: q = q.filter(Order.created_at < hasta + timedelta(days=1))
+    cursor = request.args.get('cursor', '').strip()
+    after = decode_cursor(cursor) if cursor else None
+    if after:
+        ts, oid = after
+        q = q.filter(db.or_(Order.created_at < ts, db.and_(Order.created_at == ts, Order.id < oid)))
+    orders = q.order_by(Order.created_at.desc(), Order.id.desc()).limit(COMANDAS_PAGE + 1).all()
+    next_cursor = encode_cursor(orders[COMANDAS_PAGE - 1]) if len(orders) > COMANDAS_PAGE else None
+    live = not (cursor or desde or hasta)  # solo la primera página sin fechas se actualiza en vivo
+    last_event = db.session.query(db.func.coalesce(db.func.max(OrderEvent.id), 0)).scalar() if live else None
+    return render_template('admin_comandas.html', orders=orders[:COMANDAS_PAGE], filtros=filtros,
+                           next_cursor=next_cursor, paginado=bool(cursor), last_event=last_event)
+
+DELIVERY_ORDER = ['bodega','trastienda','piso']  # de dónde se descuenta primero
+
+class StockConflict(Exception):
+    """Otro request cambió el stock entre la lectura y el descuento."""
+
+LOCK_ERRORS = {1205, 1213}  # MySQL: espera de lock vencida, deadlock (InnoDB ya revirtió la transacción)
+
+def is_lock_error(e):
+    return bool(e.orig and e.orig.args) and e.orig.args[0] in LOCK_ERRORS
+
+def deliver_order(order_id, user=None, attempts=3):
+    """Marca la comanda como entregada y descuenta el stock en una sola transacción.
 
-@app.route('/admin/comandas/<int:order_id>/entregar', methods=['POST'])
+    Devuelve None si ya estaba entregada, o la lista de (OrderItem, faltante) con SKU que no alcanzó a cubrirse.
+    Las cantidades tomadas de cada ubicación quedan en StockMovement; OrderItem.cantidad no se toca.
+    Si otra entrega concurrente se adelanta (StockConflict) o la base corta la transacción por deadlock o
+    espera de lock, se reintenta con el stock actualizado.
+    """
+    for attempt in range(attempts):
+        try:
+            return _deliver_order(order_id, user)
+        except StockConflict:
+            db.session.rollback()
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_error(e) or attempt == attempts - 1: raise
+    raise StockConflict(f'No se pudo entregar la comanda {order_id}: el stock cambió {attempts} veces')
+
+def _deliver_order(order_id, user):
+    claimed = (Order.query.filter_by(id=order_id, status='pendiente')
+               .update({'status': 'entregado'}, synchronize_session=False))
+    if not claimed:
+        db.session.rollback(); return None
+    items = OrderItem.query.filter_by(order_id=order_id).order_by(OrderItem.id).all()
+    skus = {it.sku for it in items if it.sku}
+    locs = defaultdict(list)
+    if skus:
+        rows = (db.session.query(ProductLocation.id, ProductLocation.product_id, ProductLocation.tipo,
+                                 ProductLocation.cantidad, Product.sku)
+                .join(Product).filter(Product.sku.in_(skus), ProductLocation.cantidad > 0)
+                .order_by(ProductLocation.id).with_for_update().all())  # siempre en el mismo orden: sin deadlocks
+        rank = {t: i for i, t in enumerate(DELIVERY_ORDER)}
+        for row in sorted(rows, key=lambda r: (rank.get(r.tipo, len(rank)), r.id)):
+            locs[row.sku].append(row)
+    available = {row.id: row.cantidad for rows in locs.values() for row in rows}
+    taken, movements, missing = defaultdict(int), [], []
+    for it in items:
+        need = it.cantidad
+        for loc in locs.get(it.sku, []):
+            take = min(available[loc.id], need)
+            if take <= 0: continue
+            available[loc.id] -= take; taken[loc.id] += take; need -= take
+            movements.append(StockMovement(location_id=loc.id, product_id=loc.product_id, order_item_id=it.id,
+                                           kind='entrega', cantidad=-take, created_by=user))
+            if not need: break
+        if need and it.sku: missing.append((it, need))
+    if taken:
+        # un solo UPDATE para todas las ubicaciones; cada fila solo cambia si todavía alcanza el stock leído.
+        # (no usa apply_stock_movements porque necesita esa condición y el rowcount)
+        amount = db.case(taken, value=ProductLocation.id)
+        done = db.session.execute(
+            db.update(ProductLocation)
+            .where(ProductLocation.id.in_(list(taken)), ProductLocation.cantidad >= amount)
+            .values(cantidad=ProductLocation.cantidad - amount)
+            .execution_options(synchronize_session=False)).rowcount
+        if done != len(taken): raise StockConflict()
+    by_prod = defaultdict(int)
+    for m in movements: by_prod[m.product_id] += m.cantidad
+    bump_totals(Product, 'stock', by_prod)
+    db.session.add_all(movements)
+    order = db.session.get(Order, order_id)
+    order.status = 'entregado'  # ya cambió en la base con el UPDATE de arriba
+    record_order_event(order, 'entregada', items)
+    db.session.commit()
+    return missing
+
+@bp.route('/admin/comandas/<int:order_id>/entregar', methods=['POST'])
 @login_required
 @role_required('admin','bodeguero')
 def admin_comanda_entregar(order_id):
-    o = Order.query.get_or_404(order_id)
-    if o.status == 'entregado':
+    Order.query.get_or_404(order_id)
+    try:
+        missing = deliver_order(order_id, current_user.email)
+    except StockConflict:
+        flash('El stock cambió mientras se entregaba la comanda. Intenta de nuevo.', 'danger')
+        return redirect(url_for('main.admin_comandas'))
+    if missing is None:
         flash('Esta comanda ya fue entregada', 'info')
-        return redirect(url_for('admin_comandas'))
-    for it in o.items:
-        if it.sku:
-            p = Product.query.filter_by(sku=it.sku).first()
-            if p:
-                for tipo in ['bodega','trastienda','piso']:
-                    loc = next((l for l in p.locations if l.tipo==tipo and l.cantidad>0), None)
-                    if loc:
-                        take = min(loc.cantidad, it.cantidad)
-                        loc.cantidad -= take
-                        it.cantidad -= take
-                        if it.cantidad == 0: break
-                db.session.commit()
-    o.status = 'entregado'
-    db.session.commit()
+        return redirect(url_for('main.admin_comandas'))
     flash('Comanda marcada como ENTREGADA y stock descontado.', 'success')
-    return redirect(url_for('admin_comandas'))
+    if missing:
+        flash('Sin stock suficiente para: ' + ', '.join(f'{it.nombre} (faltaron {n})' for it, n in missing), 'warning')
+    return redirect(url_for('main.admin_comandas'))
+
+# ----------------- Tablero de comandas en vivo (SSE) -----------------
+def order_payload(o, items):
+    return {'id': o.id, 'created_at': o.created_at.strftime('%Y-%m-%d %H:%M') if o.created_at else None,
+            'requested_by': o.requested_by, 'requested_for_time': o.requested_for_time, 'status': o.status,
+            'items': [{'cantidad': it.cantidad, 'nombre': it.nombre, 'sku': it.sku} for it in items]}
+
+def record_order_event(order, kind, items):
+    """Agrega el evento a la transacción actual; al hacer commit se despierta el bus de este worker."""
+    db.session.add(OrderEvent(order_id=order.id, kind=kind, payload=json.dumps(order_payload(order, items))))
+    db.session.info['wake_events'] = True
+
+def event_json(ev):
+    return {'id': ev.id, 'kind': ev.kind, 'order': json.loads(ev.payload)}
+
+class EventBus:
+    """Reparte los eventos de comandas a los clientes SSE conectados a este worker.
+
+    La tabla order_event es el registro común a todos los workers: un hilo por worker la lee con una
+    sola query por cursor (id > último visto) cada `poll` seg. mientras haya clientes, y un commit hecho
+    en este mismo worker lo despierta al instante. N tableros abiertos ya no recargan la lista completa.
+    """
+    def __init__(self, poll=1.0):
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.subscribers = set()
+        self.last_id = None
+        self.app = None
+        self.started = False
+
+    def start(self, app):
+        with self.lock:
+            if self.started: return
+            self.app, self.started = app, True
+            threading.Thread(target=self._loop, name='order-events', daemon=True).start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def subscribe(self, since, limit=None):
+        """Cola con los eventos de id > since (el cursor común retrocede si hace falta; cada stream descarta
+        repetidos), o None si este worker ya tiene `limit` clientes. Cupo y alta van juntos bajo el lock."""
+        q = queue.Queue(maxsize=500)
+        with self.lock:
+            if limit is not None and len(self.subscribers) >= limit: return None
+            self.subscribers.add(q)
+            if self.last_id is None or since < self.last_id: self.last_id = since
+        self.wake()
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock: self.subscribers.discard(q)
+
+    def _deliver(self, events):
+        for q in self.subscribers:  # con self.lock tomado
+            for ev in events:
+                try: q.put_nowait(ev)
+                except queue.Full: break  # cliente atrasado: al reconectar se pone al día con Last-Event-ID
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                active = bool(self.subscribers)
+                if not active: self.last_id = None  # sin clientes no se lee nada
+            if active:
+                with self.app.app_context():
+                    try:
+                        self._fetch()
+                    except Exception:
+                        current_app.logger.exception('Error leyendo eventos de comandas')
+                    finally:
+                        db.session.remove()
+            self.wakeup.wait(self.poll); self.wakeup.clear()
+
+    def _fetch(self):
+        while True:
+            with self.lock: cursor = self.last_id
+            if cursor is None: return
+            rows = OrderEvent.query.filter(OrderEvent.id > cursor).order_by(OrderEvent.id).limit(200).all()
+            events = [event_json(ev) for ev in rows]
+            # entregar y mover el cursor sin soltar el lock: un subscribe() queda antes (recibe estos eventos)
+            # o después (su since cuenta contra el cursor ya movido), nunca en medio
+            with self.lock:
+                self._deliver(events)
+                if self.last_id != cursor: continue  # un cliente nuevo lo bajó durante la query: releer desde ahí
+                if events: self.last_id = events[-1]['id']
+            if len(rows) < 200: return
+
+event_bus = EventBus()
+
+@event.listens_for(db.session, 'after_commit')
+def wake_event_bus(session):
+    if session.info.pop('wake_events', False): event_bus.wake()
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_event_wake(session):
+    session.info.pop('wake_events', None)
+
+def sse(ev):
+    return f"id: {ev['id']}\nevent: comanda\ndata: {json.dumps(ev, separators=(',', ':'))}\n\n"
+
+@bp.route('/api/comandas/eventos')
+@login_required
+@role_required('admin','bodeguero')
+def api_comandas_eventos():
+    """text/event-stream con los eventos posteriores a Last-Event-ID (o ?desde=<id> en la primera conexión)."""
+    cfg = current_app.config
+    event_bus.poll = cfg['EVENTS_POLL']
+    event_bus.start(current_app._get_current_object())
+    last = request.headers.get('Last-Event-ID', type=int)
+    if last is None: last = request.args.get('desde', type=int)
+    if last is None:
+        last = db.session.query(db.func.coalesce(db.func.max(OrderEvent.id), 0)).scalar()
+    # alta antes de la puesta al día: lo que se confirme mientras tanto queda en la cola (los repetidos se saltan)
+    q = event_bus.subscribe(last, limit=cfg['EVENTS_MAX_STREAMS'])
+    if q is None:
+        resp = jsonify({'error': 'Demasiados tableros conectados a este worker'}); resp.status_code = 503
+        resp.headers['Retry-After'] = '15'
+        return resp
+    def stream():
+        nonlocal last
+        yield 'retry: 3000\n\n'
+        for ev in OrderEvent.query.filter(OrderEvent.id > last).order_by(OrderEvent.id).limit(500):
+            last = ev.id; yield sse(event_json(ev))
+        db.session.remove()  # el stream no retiene una conexión del pool
+        deadline = time.monotonic() + cfg['EVENTS_STREAM_SECONDS']
+        while (left := deadline - time.monotonic()) > 0:
+            try:
+                ev = q.get(timeout=min(15, left))
+            except queue.Empty:
+                yield ': ping\n\n'; continue
+            if ev['id'] <= last: continue
+            last = ev['id']; yield sse(ev)
+    resp = current_app.response_class(stream_with_context(stream()), mimetype='text/event-stream')
+    resp.call_on_close(lambda: event_bus.unsubscribe(q))  # también si el cliente corta antes de la primera línea
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # nginx: no juntar el stream en su buffer
+    return resp
 
 # ----------------- Admin: Import CSV/XLS/XLSX -----------------
-@app.route('/admin/importar', methods=['GET','POST'])
+IMPORT_CHUNK = 1000  # filas por transacción
+IMPORT_LOC_COLS = ['tipo','pasillo','rack','cantidad']
+
+@timed('import_leer')
+def read_import_file(f, filename):
+    import pandas as pd  # pandas (y xlrd/openpyxl) solo se cargan al importar, no al arrancar el worker
+    ext = filename.rsplit('.',1)[-1].lower()
+    if ext == 'csv':
+        return pd.read_csv(f, dtype=str, keep_default_na=False)
+    return pd.read_excel(f, engine='xlrd' if ext == 'xls' else 'openpyxl', dtype=str)
+
+@timed('import_normalizar')
+def normalize_import(df):
+    """Columnas del archivo -> DataFrame limpio (operaciones vectorizadas) + errores por fila.
+    Lanza ValueError si falta una columna requerida."""
+    import pandas as pd
+    df = df.rename(columns=lambda c: str(c).lower().strip())
+    df = df.loc[:, ~df.columns.duplicated()]
+    for r in ['sku','nombre']:
+        if r not in df.columns: raise ValueError(f'Falta columna requerida: {r}')
+    def text(col):
+        if col not in df.columns: return pd.Series(pd.NA, index=df.index, dtype='string')
+        return df[col].astype('string').str.strip().replace('', pd.NA)
+    rows = pd.DataFrame({'fila': df.index + 1, 'sku': text('sku'), 'nombre': text('nombre'),
+                         'categoria': text('categoria'), 'comentarios': text('comentarios'),
+                         'tipo': text('tipo').str.lower().fillna('piso'), 'pasillo': text('pasillo'), 'rack': text('rack')})
+    rows['cantidad'] = (pd.to_numeric(df['cantidad'], errors='coerce').fillna(0).astype(int)
+                        if 'cantidad' in df.columns else 0)
+    # una fila sin ningún dato de ubicación solo crea/actualiza el producto (así se exportan los productos sin ubicación)
+    loc_cols = [c for c in IMPORT_LOC_COLS if c in df.columns]
+    rows['con_ubicacion'] = pd.concat([text(c).notna() for c in loc_cols], axis=1).any(axis=1) if loc_cols else False
+    rows = rows[rows['sku'].notna()]  # filas sin sku se ignoran
+    checks = [(rows['nombre'].isna(), 'falta nombre'), (rows['sku'].str.len() > 64, 'sku de más de 64 caracteres'),
+              (rows['nombre'].str.len() > 200, 'nombre de más de 200 caracteres')]
+    bad = pd.Series(False, index=rows.index)
+    errors = []
+    for mask, msg in checks:
+        mask = mask.fillna(False) & ~bad
+        errors += [(int(f), msg) for f in rows.loc[mask, 'fila']]
+        bad |= mask
+    return rows[~bad].astype(object).where(rows[~bad].notna(), None), sorted(errors)
+
+def upsert_import_locations(locs):
+    """Ubicaciones del archivo. Las que ya existen (mismo producto, tipo, pasillo y rack) quedan con la cantidad
+    del archivo mediante un movimiento 'importacion' por la diferencia; las demás se crean con su movimiento
+    inicial. Así exportar -> editar -> importar no duplica ubicaciones ni stock."""
+    locs = locs.drop_duplicates(['product_id','tipo','pasillo','rack'], keep='last')  # la última fila manda
+    current = {}  # (product_id, tipo, pasillo, rack) -> (id, cantidad); si ya hay repetidas, la más antigua
+    for lid, pid, tipo, pasillo, rack, cantidad in db.session.execute(
+            db.select(ProductLocation.id, ProductLocation.product_id, ProductLocation.tipo, ProductLocation.pasillo,
+                      ProductLocation.rack, ProductLocation.cantidad)
+            .where(ProductLocation.product_id.in_(set(locs['product_id']))).order_by(ProductLocation.id).with_for_update()):
+        current.setdefault((pid, tipo, pasillo, rack), (lid, cantidad or 0))
+    fresh, moves = [], []
+    for r in locs.to_dict('records'):
+        hit = current.get((r['product_id'], r['tipo'], r['pasillo'], r['rack']))
+        if hit is None: fresh.append(r)
+        elif r['cantidad'] != hit[1]:
+            moves.append(StockMovement(location_id=hit[0], product_id=r['product_id'], kind='importacion',
+                                       cantidad=r['cantidad'] - hit[1]))
+    if moves: apply_stock_movements(moves)
+    if fresh:
+        last_id = db.session.query(db.func.coalesce(db.func.max(ProductLocation.id), 0)).scalar()
+        db.session.execute(db.insert(ProductLocation), fresh)
+        record_opening_movements('importacion', after_id=last_id)
+        refresh_product_stock({r['product_id'] for r in fresh})
+
+@timed('import_total')
+def import_products(df, dry_run=False, chunk_size=IMPORT_CHUNK, start_row=0, progress=None, checkpoint=None):
+    """Upsert masivo de productos y de sus ubicaciones: 1 query para los SKUs existentes y una
+    transacción por bloque de `chunk_size` filas. Si un bloque falla se revierte solo ese bloque.
+    Con dry_run=True no escribe nada y solo cuenta lo que haría. `start_row` salta los bloques ya
+    confirmados (reanudar); `checkpoint(filas_hechas, total, parcial)` se llama justo antes del commit
+    de cada bloque (lo que escriba va en la misma transacción) y `progress(...)`, con los mismos
+    argumentos, después de cada bloque."""
+    t0 = time.perf_counter()
+    rows, errors = normalize_import(df)
+    existing = dict(db.session.query(Product.sku, Product.id))
+    created = updated = locations = 0
+    touched = set()
+    def summary():
+        elapsed = time.perf_counter() - t0
+        return {'created': created, 'updated': updated, 'locations': locations, 'errors': sorted(errors),
+                'rows': len(df), 'seconds': elapsed, 'rows_per_sec': len(df) / elapsed if elapsed else 0, 'dry_run': dry_run}
+    def tally(new, old, prods, chunk):
+        nonlocal created, updated, locations
+        created += len(new)
+        updated += len(set(old['sku']) - touched)
+        touched.update(prods['sku'])
+        locations += int(chunk['con_ubicacion'].astype(bool).sum())
+    for start in range(start_row, len(rows), chunk_size):
+        done = min(start + chunk_size, len(rows))
+        chunk = rows.iloc[start:start + chunk_size]
+        prods = chunk.drop_duplicates('sku', keep='last')  # la última fila de cada sku manda
+        is_new = ~prods['sku'].isin(list(existing))
+        new, old = prods[is_new], prods[~is_new]
+        fields = ['sku','nombre','categoria','comentarios']
+        if dry_run:
+            existing.update(dict.fromkeys(new['sku'], None))
+            tally(new, old, prods, chunk)
+        else:
+            counts = created, updated, locations, set(touched)
+            try:
+                if len(new): db.session.execute(db.insert(Product), new[fields].to_dict('records'))
+                if len(old):
+                    upd = old[fields[1:]].assign(id=old['sku'].map(existing))
+                    db.session.execute(db.update(Product), upd.to_dict('records'))
+                ids = dict(existing)
+                if len(new):
+                    ids.update(db.session.query(Product.sku, Product.id).filter(Product.sku.in_(list(new['sku']))))
+                touch_catalog(*prods['sku'].map(ids))
+                with_loc = chunk[chunk['con_ubicacion'].astype(bool)]
+                if len(with_loc):
+                    upsert_import_locations(with_loc[IMPORT_LOC_COLS].assign(product_id=with_loc['sku'].map(ids)))
+                    invalidate_on_commit('pasillos')
+                invalidate_on_commit('producto:*')
+                tally(new, old, prods, chunk)
+                if checkpoint: checkpoint(done, len(rows), summary())
+                db.session.commit()
+                existing = ids
+            except Exception as e:
+                db.session.rollback()
+                created, updated, locations, touched = counts
+                errors += [(int(f), str(e).splitlines()[0]) for f in chunk['fila']]
+                chunk = chunk[:0]
+        metrics.inc('import_rows_total', {'dry_run': str(dry_run).lower()}, len(chunk))
+        if progress: progress(done, len(rows), summary())
+    return summary()
+
+@job_handler('import')
+def run_import_job(job, progress):
+    """Importa en segundo plano. Las filas hechas + conteos se guardan en el trabajo en la misma transacción
+    que cada bloque, así un reinicio del worker continúa donde quedó en vez de duplicar ubicaciones."""
+    data = json.loads(job.payload)
+    prev = json.loads(job.result) if job.result else {}
+    def merge(res):
+        for k in ('created', 'updated', 'locations'): res[k] += prev.get(k, 0)
+        res['errors'] = sorted({tuple(e) for e in prev.get('errors', [])} | set(res['errors']))
+        return res
+    def save(done, total, partial):
+        data['done_rows'] = done
+        job.payload, job.result = json.dumps(data), json.dumps(merge(partial))
+    def on_chunk(done, total, partial):
+        save(done, total, partial)  # ya guardado si el bloque hizo commit; si falló o es dry_run, acá
+        progress(done * 100 / max(total, 1))
+    try:
+        df = read_import_file(data['path'], data['filename'])
+        res = merge(import_products(df, dry_run=data.get('dry_run', False), start_row=data.get('done_rows', 0),
+                                    progress=on_chunk, checkpoint=save))
+    finally:
+        # terminó bien o con error: el archivo del proveedor no se guarda (si el worker muere no se llega acá y
+        # el reintento lo encuentra para reanudar)
+        try: os.remove(data['path'])
+        except OSError: pass
+    if not res['dry_run'] and current_app.config['SEARCH_INDEX']: search_index.rebuild()
+    return res
+
+@bp.route('/admin/importar', methods=['GET','POST'])
 @login_required
 @role_required('admin','bodeguero')
 def admin_importar():
-    created, updated, errors = 0, 0, []
     if request.method == 'POST':
         f = request.files.get('archivo')
         if not f or not f.filename:
             flash('Sube un archivo CSV o XLS/XLSX', 'danger'); return redirect(request.url)
-        ext = f.filename.rsplit('.',1)[-1].lower()
+        folder = os.path.join(current_app.config['PRIVATE_FOLDER'], 'imports')  # /uploads no lo sirve
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{uuid.uuid4().hex}_{secure_filename(f.filename) or 'archivo.csv'}")
+        f.save(path)
+        job = enqueue_job('import', path=path, filename=f.filename, dry_run=bool(request.form.get('dry_run')))
+        return redirect(url_for('main.admin_importar', job=job.id))
+    job = Job.query.get(request.args.get('job', type=int)) if request.args.get('job') else None
+    return render_template('admin_importar.html', job=job_json(job) if job and job.kind == 'import' else None)
+
+# ----------------- Admin: Exportar CSV/XLSX -----------------
+EXPORT_COLS = ['sku','nombre','categoria','comentarios'] + IMPORT_LOC_COLS  # mismo formato que acepta el importador
+EXPORT_BATCH = 2000  # productos por query y por bloque enviado
+EXPORT_KEEP = 24 * 3600  # seg. que se guarda un XLSX generado en segundo plano
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def export_rows():
+    """Una fila por ubicación (o una sola, sin ubicación, si el producto no tiene) en orden de id, por bloques
+    de EXPORT_BATCH productos (keyset por id): la memoria no depende del tamaño del catálogo y entre bloques
+    no queda ningún cursor abierto, así el trabajo de XLSX puede hacer commit de su avance."""
+    after = 0
+    while True:
+        ids = db.session.execute(db.select(Product.id).where(Product.id > after)
+                                 .order_by(Product.id).limit(EXPORT_BATCH)).scalars().all()
+        if not ids: return
+        q = (db.select(Product.sku, Product.nombre, Product.categoria, Product.comentarios,
+                       ProductLocation.tipo, ProductLocation.pasillo, ProductLocation.rack, ProductLocation.cantidad)
+             .outerjoin(ProductLocation, ProductLocation.product_id == Product.id)
+             .where(Product.id.between(ids[0], ids[-1])).order_by(Product.id, ProductLocation.id))
+        yield db.session.execute(q).all()
+        if len(ids) < EXPORT_BATCH: return
+        after = ids[-1]
+
+def export_csv():
+    buf = io.StringIO()
+    out = csv.writer(buf)
+    out.writerow(EXPORT_COLS)
+    for part in export_rows():
+        out.writerows(part)
+        yield buf.getvalue(); buf.seek(0); buf.truncate()
+    yield buf.getvalue()
+
+def export_xlsx(fileobj, progress=None):
+    """Workbook write_only: openpyxl va escribiendo las filas a disco en vez de armar la hoja en memoria.
+    `progress(filas_hechas, total)` se llama tras cada bloque. Devuelve las filas escritas."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('productos')
+    ws.append(EXPORT_COLS)
+    total = (db.session.query(db.func.count(Product.id)).outerjoin(ProductLocation, ProductLocation.product_id == Product.id)
+             .scalar() if progress else 0)
+    done = 0
+    for part in export_rows():
+        for row in part: ws.append(list(row))
+        done += len(part)
+        if progress: progress(done, total)
+    wb.save(fileobj)
+    return done
+
+@job_handler('export')
+def run_export_job(job, progress):
+    """Arma el XLSX en segundo plano (openpyxl tarda ~1 min con 400k filas y no debe ocupar un worker web).
+    Se escribe a un temporal y se renombra: si el worker muere a la mitad el reintento empieza de cero."""
+    data = json.loads(job.payload)
+    t0 = time.perf_counter()
+    tmp = data['path'] + '.tmp'
+    with open(tmp, 'wb') as f:
+        rows = export_xlsx(f, lambda done, total: progress(done * 100 / max(total, 1)))
+    os.replace(tmp, data['path'])
+    folder, cutoff = os.path.dirname(data['path']), time.time() - EXPORT_KEEP
+    for fn in os.listdir(folder):  # los de exportaciones anteriores ya vencidas
+        path = os.path.join(folder, fn)
         try:
-            if ext == 'csv':
-                df = pd.read_csv(f)
-            elif ext == 'xls':
-                df = pd.read_excel(f, engine='xlrd')
-            else:
-                df = pd.read_excel(f, engine='openpyxl')
-        except Exception as e:
-            flash(f'Error leyendo archivo: {e}', 'danger'); return redirect(request.url)
-        cols = {c.lower().strip(): c for c in df.columns}
-        required = ['sku','nombre']
-        for r in required:
-            if r not in cols:
-                flash(f'Falta columna requerida: {r}', 'danger'); return redirect(request.url)
-        for i, row in df.iterrows():
-            try:
-                sku = str(row[cols['sku']]).strip()
-                if not sku: continue
-                nombre = str(row[cols['nombre']]).strip()
-                categoria = str(row[cols['categoria']]).strip() if 'categoria' in cols and not pd.isna(row[cols['categoria']]) else None
-                comentarios = str(row[cols['comentarios']]).strip() if 'comentarios' in cols and not pd.isna(row[cols['comentarios']]) else None
-                p = Product.query.filter_by(sku=sku).first()
-                if p:
-                    p.nombre = nombre; p.categoria = categoria; p.comentarios = comentarios; updated += 1
-                else:
-                    p = Product(sku=sku, nombre=nombre, categoria=categoria, comentarios=comentarios); db.session.add(p); created += 1
-                db.session.commit()
-                if any(k in cols for k in ['tipo','pasillo','rack','cantidad']):
-                    tipo = (str(row[cols.get('tipo')]).strip().lower() if 'tipo' in cols and not pd.isna(row[cols.get('tipo')]) else 'piso')
-                    pasillo = str(row[cols.get('pasillo')]).strip() if 'pasillo' in cols and not pd.isna(row[cols.get('pasillo')]) else None
-                    rack = str(row[cols.get('rack')]).strip() if 'rack' in cols and not pd.isna(row[cols.get('rack')]) else None
-                    try:
-                        cantidad = int(row[cols.get('cantidad')]) if 'cantidad' in cols and not pd.isna(row[cols.get('cantidad')]) else 0
-                    except Exception: cantidad = 0
-                    db.session.add(ProductLocation(product=p, tipo=tipo, pasillo=pasillo, rack=rack, cantidad=cantidad))
-                    db.session.commit()
-            except Exception as e:
-                errors.append(f'Fila {i+1}: {e}')
-        flash(f'Importación OK. Creados: {created}, Actualizados: {updated}. Errores: {len(errors)}', 'success')
-        if errors: flash('\n'.join(errors[:5]) + ('\n...' if len(errors)>5 else ''), 'warning')
-        return redirect(url_for('inventario'))
-    return render_template('admin_importar.html')
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+        except OSError:
+            pass
+    return {'rows': rows, 'seconds': time.perf_counter() - t0}
+
+@bp.route('/admin/exportar.<formato>', methods=['GET','POST'])
+@login_required
+@role_required('admin','bodeguero')
+def admin_exportar(formato):
+    name = f"productos-{datetime.utcnow():%Y%m%d-%H%M}.{formato}"
+    if formato == 'csv' and request.method == 'GET':
+        resp = current_app.response_class(stream_with_context(export_csv()), mimetype='text/csv; charset=utf-8')
+        resp.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+        return resp
+    if formato == 'xlsx':
+        # un .xlsx es un zip: no se puede enviar antes de terminarlo, así que lo arma el runner de trabajos.
+        # Solo por POST: un GET (prefetch del navegador, <img> de otro sitio) no debe encolar trabajo
+        if request.method != 'POST': abort(405)
+        folder = os.path.join(current_app.config['PRIVATE_FOLDER'], 'exports')
+        os.makedirs(folder, exist_ok=True)
+        job = enqueue_job('export', path=os.path.join(folder, f'{uuid.uuid4().hex}.xlsx'), name=name)
+        return redirect(url_for('main.admin_exportacion', job_id=job.id))
+    abort(404)
+
+@bp.route('/admin/exportaciones/<int:job_id>')
+@login_required
+@role_required('admin','bodeguero')
+def admin_exportacion(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.kind != 'export': abort(404)
+    return render_template('admin_exportar.html', job=job_json(job))
+
+@bp.route('/admin/exportaciones/<int:job_id>/archivo')
+@login_required
+@role_required('admin','bodeguero')
+def admin_exportacion_archivo(job_id):
+    job = Job.query.get_or_404(job_id)
+    data = json.loads(job.payload)
+    if job.kind != 'export' or job.status != 'ok' or not os.path.isfile(data['path']): abort(404)
+    return send_file(data['path'], mimetype=XLSX_MIME, as_attachment=True, download_name=data['name'])
+
+# ----------------- Stock: libro de movimientos + totales materializados -----------------
+def bump_totals(model, column, deltas):
+    """UPDATE model SET column = column + CASE id ... END para varios ids en un solo statement."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas: return
+    col = getattr(model, column)
+    if model is Product:
+        invalidate_on_commit(*(f'producto:{pid}' for pid in deltas)); touch_catalog(*deltas)
+    db.session.execute(db.update(model).where(model.id.in_(list(deltas)))
+                       .values({column: col + db.case(deltas, value=model.id)})
+                       .execution_options(synchronize_session=False))
+
+def apply_stock_movements(movements):
+    """Agrega los movimientos al libro y mueve en la misma transacción (sin commit) los totales de
+    ProductLocation.cantidad y Product.stock con UPDATEs relativos, así dos requests no se pisan."""
+    by_loc, by_prod = defaultdict(int), defaultdict(int)
+    for m in movements:
+        by_loc[m.location_id] += m.cantidad; by_prod[m.product_id] += m.cantidad
+    db.session.add_all(movements)
+    bump_totals(ProductLocation, 'cantidad', by_loc)
+    bump_totals(Product, 'stock', by_prod)
+
+def record_opening_movements(kind, after_id=None):
+    """Un movimiento `kind` por la cantidad actual de cada ubicación (con id > after_id) que todavía no
+    tiene ninguno: ubicaciones importadas en bloque o anteriores al libro. INSERT ... SELECT, sin traer filas."""
+    pl, sm = ProductLocation.__table__, StockMovement.__table__
+    has_moves = db.select(sm.c.id).where(sm.c.location_id == pl.c.id).exists()
+    src = db.select(pl.c.id, pl.c.product_id, db.literal(kind), db.func.coalesce(pl.c.cantidad, 0),
+                    db.literal(datetime.utcnow())).where(~has_moves)
+    if after_id is not None: src = src.where(pl.c.id > after_id)
+    return db.session.execute(sm.insert().from_select(
+        ['location_id', 'product_id', 'kind', 'cantidad', 'created_at'], src)).rowcount
+
+def refresh_product_stock(ids):
+    """Recalcula Product.stock de esos productos desde sus ubicaciones (un solo UPDATE)."""
+    ids = list(ids)
+    if not ids: return
+    touch_catalog(*ids)
+    total = (db.select(db.func.coalesce(db.func.sum(ProductLocation.cantidad), 0))
+             .where(ProductLocation.product_id == Product.id).scalar_subquery())
+    db.session.execute(db.update(Product).where(Product.id.in_(ids)).values(stock=total)
+                       .execution_options(synchronize_session=False))
+
+def reconcile_stock(fix=True):
+    """Reconstruye los totales desde el libro y devuelve las diferencias encontradas:
+    {'aperturas': n, 'ubicaciones': [(id, guardado, libro)], 'productos': [(id, guardado, libro)]}."""
+    opened = record_opening_movements('apertura')
+    ledger = dict(db.session.query(StockMovement.location_id, db.func.sum(StockMovement.cantidad))
+                  .group_by(StockMovement.location_id))
+    expected = defaultdict(int)
+    loc_drift = []
+    for lid, pid, cantidad in db.session.query(ProductLocation.id, ProductLocation.product_id, ProductLocation.cantidad):
+        real = int(ledger.get(lid) or 0)
+        expected[pid] += real
+        if (cantidad or 0) != real: loc_drift.append((lid, cantidad, real))
+    prod_drift = [(pid, stock, expected[pid]) for pid, stock in db.session.query(Product.id, Product.stock)
+                  if stock != expected[pid]]
+    if fix:
+        invalidate_on_commit('producto:*')
+        if loc_drift:
+            db.session.execute(db.update(ProductLocation), [{'id': lid, 'cantidad': real} for lid, _, real in loc_drift])
+        if prod_drift:
+            db.session.execute(db.update(Product), [{'id': pid, 'stock': real} for pid, _, real in prod_drift])
+            touch_catalog(*(pid for pid, _, _ in prod_drift))
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return {'aperturas': opened, 'ubicaciones': loc_drift, 'productos': prod_drift}
+
+@bp.cli.command('stock-reconciliar')
+@click.option('--solo-reportar', is_flag=True, help='Muestra las diferencias sin corregirlas.')
+def stock_reconciliar(solo_reportar):
+    """Recalcula stock por ubicación y por producto desde el libro de movimientos."""
+    res = reconcile_stock(fix=not solo_reportar)
+    print(f"Aperturas creadas: {res['aperturas']}{' (no guardadas)' if solo_reportar else ''}")
+    for name in ('ubicaciones', 'productos'):
+        print(f"{name.capitalize()} con diferencias: {len(res[name])}")
+        for rid, stored, real in res[name][:20]: print(f'  #{rid}: guardado={stored} libro={real}')
+
+def stock_totals(ids):
+    """{product_id: stock} leyendo Product.stock por clave primaria."""
+    ids = list(ids)
+    out = dict.fromkeys(ids, 0)
+    if ids:
+        out.update(db.session.query(Product.id, Product.stock).filter(Product.id.in_(ids)))
+    return out
+
+@bp.route('/producto/<int:product_id>/ubicacion/<int:location_id>/ajustar', methods=['POST'])
+@login_required
+@role_required('admin','bodeguero')
+def producto_ajustar_ubicacion(product_id, location_id):
+    # FOR UPDATE: el delta se calcula sobre la cantidad bloqueada; una entrega o ajuste concurrente espera al commit
+    loc = ProductLocation.query.filter_by(id=location_id, product_id=product_id).with_for_update().first_or_404()
+    try:
+        nueva = int(request.form.get('cantidad', ''))
+    except ValueError:
+        flash('Cantidad inválida', 'danger'); return redirect(url_for('main.producto_editar', product_id=product_id))
+    if nueva < 0:
+        flash('La cantidad no puede ser negativa', 'danger'); return redirect(url_for('main.producto_editar', product_id=product_id))
+    delta = nueva - (loc.cantidad or 0)
+    if delta:
+        apply_stock_movements([StockMovement(location_id=loc.id, product_id=product_id, kind='ajuste',
+                                             cantidad=delta, created_by=current_user.email)])
+        db.session.commit()
+    flash('Cantidad ajustada', 'success')
+    return redirect(url_for('main.producto_editar', product_id=product_id))
 
 # ----------------- API stock -----------------
-@app.route('/api/stock/<int:product_id>')
+
+@bp.route('/api/stock/<int:product_id>')
+@query_budget(1)
+@read_replica
 def api_stock(product_id):
     p = Product.query.get_or_404(product_id)
-    stock = sum(loc.cantidad for loc in p.locations)
-    return jsonify({"product_id": p.id, "stock": stock})
+    return jsonify({"product_id": p.id, "stock": p.stock})  # total materializado: sin segunda query
+
+@bp.route('/api/stock', methods=['POST'])
+@query_budget(1)
+@read_replica
+def api_stock_bulk():
+    """Stock de varios productos en una sola llamada: POST {"ids": [1, 2, ...]} -> {"stock": {"1": 10, ...}}.
+    Responde 304 si el cliente manda If-None-Match con el ETag de la respuesta anterior y nada cambió."""
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": 'se espera un objeto {"ids": [...]}'}), 400
+    try:
+        ids = payload.get('ids', [])
+        if not isinstance(ids, list): raise TypeError  # un string se iteraría como dígitos sueltos
+        ids = sorted({int(i) for i in ids})
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids debe ser una lista de enteros"}), 400
+    totals = stock_totals(ids)
+    body = json.dumps({"stock": totals}, separators=(',', ':'))
+    etag = hashlib.md5(body.encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = current_app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag); resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+# ----------------- Catálogo para escáneres (snapshot + cambios) -----------------
+CATALOG_COLS = ['id','sku','nombre','stock','tipo','pasillo','rack','thumb']  # cada producto es una lista en este orden
+CATALOG_BATCH = 2000  # productos por query al armar el snapshot (keyset por id)
+CATALOG_DELTA_LIMIT = 5000  # productos por respuesta de /api/catalogo/cambios
+
+def touch_catalog(*product_ids):
+    """Marca productos como modificados; al hacer commit quedan en catalog_change en la misma transacción.
+    Los cambios por ORM se detectan solos (track_catalog); esto es para los UPDATE/INSERT en bloque."""
+    db.session.info.setdefault('catalog_changes', set()).update(int(i) for i in product_ids if i)
+
+@event.listens_for(db.session, 'after_flush')
+def track_catalog(session, flush_context):
+    ids = session.info.setdefault('catalog_changes', set())
+    for obj in (*session.new, *session.dirty):
+        if isinstance(obj, Product): ids.add(obj.id)
+        elif isinstance(obj, ProductLocation): ids.add(obj.product_id)
+        elif isinstance(obj, ProductLocationPhoto) and obj.location is not None: ids.add(obj.location.product_id)
+
+@event.listens_for(db.session, 'before_commit')
+def write_catalog_changes(session):
+    session.flush()  # los objetos pendientes pasan por track_catalog antes de escribir el registro
+    ids = session.info.pop('catalog_changes', None)
+    if not ids: return
+    # UPDATE primero: toma el lock de la fila (o el de escritura en SQLite) antes de leer el valor
+    session.execute(db.update(CatalogSeq).where(CatalogSeq.id == 1).values(value=CatalogSeq.value + len(ids)))
+    last = session.execute(db.select(CatalogSeq.value).where(CatalogSeq.id == 1)).scalar_one()
+    first = last - len(ids) + 1
+    session.execute(db.insert(CatalogChange), [{'id': first + n, 'product_id': i} for n, i in enumerate(sorted(ids))])
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_catalog_changes(session):
+    session.info.pop('catalog_changes', None)
+
+def catalog_version():
+    return db.session.query(db.func.coalesce(db.func.max(CatalogSeq.value), 0)).scalar()
+
+def catalog_rows(ids=None):
+    """Filas compactas (CATALOG_COLS) de todos los productos o de `ids`, por bloques de CATALOG_BATCH con
+    3 queries cada uno: productos, sus ubicaciones y las fotos de esas ubicaciones. El snapshot completo
+    filtra ubicaciones y fotos por rango de product_id (índice) en vez de IN con miles de parámetros."""
+    rank = {t: i for i, t in enumerate(PRIMARY_LOC)}
+    after = 0
+    while True:
+        q = (db.select(Product.id, Product.sku, Product.nombre, Product.stock, Product.image_url, Product.image_file)
+             .where(Product.id > after).order_by(Product.id).limit(CATALOG_BATCH))
+        if ids is not None: q = q.where(Product.id.in_(ids))
+        prods = db.session.execute(q).all()
+        if not prods: return
+        batch = (ProductLocation.product_id.in_([p[0] for p in prods]) if ids is not None
+                 else ProductLocation.product_id.between(after + 1, prods[-1][0]))
+        after = prods[-1][0]
+        primary = {}  # product_id -> (location_id, tipo, pasillo, rack)
+        for lid, pid, tipo, pasillo, rack in db.session.execute(
+                db.select(ProductLocation.id, ProductLocation.product_id, ProductLocation.tipo, ProductLocation.pasillo,
+                          ProductLocation.rack).where(batch).order_by(ProductLocation.id)):
+            cur = primary.get(pid)
+            if cur is None or rank.get(tipo, len(rank)) < rank.get(cur[1], len(rank)): primary[pid] = (lid, tipo, pasillo, rack)
+        photos = {}  # location_id -> primera foto
+        for lid, filename in db.session.execute(
+                db.select(ProductLocationPhoto.location_id, ProductLocationPhoto.filename)
+                .join(ProductLocation).where(batch).order_by(ProductLocationPhoto.id)):
+            photos.setdefault(lid, filename)
+        for pid, sku, nombre, stock, image_url, image_file in prods:
+            lid, tipo, pasillo, rack = primary.get(pid, (None, None, None, None))
+            thumb = image_url or (media_url(image_file, 'thumb') if image_file else None)
+            if not thumb and lid in photos: thumb = media_url(photos[lid], 'thumb')
+            yield [pid, sku, nombre, stock, tipo, pasillo, rack, thumb]
+        if len(prods) < CATALOG_BATCH: return
+
+class CatalogSnapshot:
+    """Último snapshot armado en este worker, ya comprimido: todos los escáneres piden la misma versión."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.body = None
+
+    def get(self, version):
+        with self.lock:
+            if self.version != version:
+                data = {'version': version, 'columnas': CATALOG_COLS, 'productos': list(catalog_rows())}
+                self.body = gzip.compress(json.dumps(data, separators=(',', ':')).encode(), 6)
+                self.version = version
+            return self.body
+
+catalog_snapshot = CatalogSnapshot()
+
+def gzip_response(body, compressed=False):
+    """JSON comprimido si el cliente acepta gzip (los escáneres sí); si no, sin comprimir."""
+    gz = 'gzip' in request.accept_encodings
+    if gz and not compressed: body = gzip.compress(body, 6)
+    elif compressed and not gz: body = gzip.decompress(body)
+    resp = current_app.response_class(body, mimetype='application/json')
+    if gz: resp.headers['Content-Encoding'] = 'gzip'
+    resp.vary.add('Accept-Encoding')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+@bp.route('/api/catalogo')
+@read_replica
+def api_catalogo():
+    """Catálogo completo para que el escáner resuelva SKUs sin red: {"version", "columnas", "productos": [[...]]}.
+    Con If-None-Match de la versión que ya tiene responde 304; después basta con /api/catalogo/cambios."""
+    version = catalog_version()
+    etag = f'catalogo-{version}'
+    if request.if_none_match.contains_weak(etag):
+        resp = current_app.response_class(status=304)
+        resp.set_etag(etag, weak=True)
+        return resp
+    resp = gzip_response(catalog_snapshot.get(version), compressed=True)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+@bp.route('/api/catalogo/cambios')
+@read_replica
+def api_catalogo_cambios():
+    """?desde=<version> -> productos modificados después, en el mismo formato que el snapshot. Si `mas` es true
+    hay que volver a pedir con desde=version. El escáner reemplaza cada fila por id (aplicarla dos veces no daña)."""
+    desde = request.args.get('desde', type=int)
+    if desde is None: return jsonify({'error': 'falta desde'}), 400
+    changes = (db.session.query(CatalogChange.product_id, db.func.max(CatalogChange.id).label('seq'))
+               .filter(CatalogChange.id > desde).group_by(CatalogChange.product_id)
+               .order_by(db.func.max(CatalogChange.id)).limit(CATALOG_DELTA_LIMIT + 1).all())
+    mas = len(changes) > CATALOG_DELTA_LIMIT
+    changes = changes[:CATALOG_DELTA_LIMIT]
+    version = changes[-1].seq if changes else desde
+    rows = list(catalog_rows([c.product_id for c in changes])) if changes else []
+    data = {'version': version, 'mas': mas, 'columnas': CATALOG_COLS, 'productos': rows}
+    return gzip_response(json.dumps(data, separators=(',', ':')).encode())
 
 # ----------------- Admin core -----------------
-@app.route('/admin')
+@bp.route('/admin')
 @login_required
 @role_required('admin','bodeguero')
 def admin_dashboard():
@@ -427,22 +2179,24 @@ def admin_dashboard():
     pedidos_pend = Order.query.filter_by(status='pendiente').count()
     return render_template('admin_dashboard.html', productos=productos, pedidos_pend=pedidos_pend)
 
-@app.route('/admin/planograma', methods=['GET','POST'])
+@bp.route('/admin/planograma', methods=['GET','POST'])
 @login_required
 @role_required('admin','bodeguero')
 def admin_planograma():
     p = Planograma.query.first()
     if not p:
         p = Planograma(titulo="Planograma general", contenido="Escribe aquí tu planograma...")
+        invalidate_on_commit('planograma')
         db.session.add(p); db.session.commit()
     if request.method == 'POST':
         p.titulo = request.form.get('titulo', p.titulo)
         p.contenido = request.form.get('contenido', p.contenido)
+        invalidate_on_commit('planograma')
         db.session.commit()
         flash('Planograma actualizado', 'success')
     return render_template('admin_planograma.html', planograma=p)
 
-@app.route('/admin/educacion/nuevo', methods=['GET','POST'])
+@bp.route('/admin/educacion/nuevo', methods=['GET','POST'])
 @login_required
 @role_required('admin','bodeguero')
 def admin_educacion_nuevo():
@@ -451,20 +2205,22 @@ def admin_educacion_nuevo():
         descripcion = request.form.get('descripcion','').strip()
         if not titulo:
             flash('Título es obligatorio', 'danger'); return redirect(request.url)
-        curso = Curso(titulo=titulo, descripcion=descripcion); db.session.add(curso); db.session.commit()
+        curso = Curso(titulo=titulo, descripcion=descripcion); db.session.add(curso); db.session.flush()
+        invalidate_on_commit('cursos')
         files = request.files.getlist('media')
         for f in files:
             fn = save_file(f)
             if fn:
-                ext = (fn.rsplit('.',1)[-1] or '').lower()
-                media_type = 'video' if ext in ['mp4','mov','webm'] else 'image' if ext in ['jpg','jpeg','png','gif','webp'] else 'file'
+                ext = file_ext(fn)
+                media_type = 'video' if ext in VIDEO_EXTS else 'image' if ext in IMAGE_EXTS else 'file'
                 db.session.add(CursoMedia(curso=curso, filename=fn, media_type=media_type))
+        invalidate_on_commit(f'curso:{curso.id}')
         db.session.commit()
         flash('Curso creado', 'success')
-        return redirect(url_for('educacion_list'))
+        return redirect(url_for('main.educacion_list'))
     return render_template('admin_educacion_nuevo.html')
 
-@app.route('/admin/usuarios', methods=['GET','POST'])
+@bp.route('/admin/usuarios', methods=['GET','POST'])
 @login_required
 @role_required('admin')
 def admin_usuarios():
@@ -479,21 +2235,64 @@ def admin_usuarios():
             flash('Ya existe un usuario con ese email', 'danger'); return redirect(request.url)
         u = User(email=email, name=name, role=role); u.set_password(password)
         db.session.add(u); db.session.commit()
-        flash('Usuario creado', 'success'); return redirect(url_for('admin_usuarios'))
+        flash('Usuario creado', 'success'); return redirect(url_for('main.admin_usuarios'))
     users = User.query.all()
     return render_template('admin_usuarios.html', users=users)
 
 # Educación (público)
-@app.route('/educacion')
+@bp.route('/educacion')
 def educacion_list():
-    cursos = Curso.query.order_by(Curso.id.desc()).all()
-    return render_template('educacion_list.html', cursos=cursos)
+    def load():
+        return [{'id': c.id, 'titulo': c.titulo, 'descripcion': c.descripcion}
+                for c in Curso.query.order_by(Curso.id.desc())]
+    return render_template('educacion_list.html', cursos=cached('cursos', load))
 
-@app.route('/educacion/<int:curso_id>')
+@bp.route('/educacion/<int:curso_id>')
 def educacion_detalle(curso_id):
-    c = Curso.query.get_or_404(curso_id)
-    return render_template('educacion_detalle.html', curso=c)
+    def load():
+        c = db.get_or_404(Curso, curso_id)
+        return {'id': c.id, 'titulo': c.titulo, 'descripcion': c.descripcion,
+                'media': [{'filename': m.filename, 'media_type': m.media_type} for m in c.media]}
+    return render_template('educacion_detalle.html', curso=cached(f'curso:{curso_id}', load))
+
+def ensure_catalog_seq():
+    if db.session.get(CatalogSeq, 1) is None:
+        last = db.session.query(db.func.coalesce(db.func.max(CatalogChange.id), 0)).scalar()
+        db.session.add(CatalogSeq(id=1, value=last)); db.session.commit()
+
+def init_db():
+    db.create_all(); added = ensure_columns(); ensure_indexes(); ensure_admin(); ensure_catalog_seq()
+    if 'product.stock' in added: reconcile_stock()  # primera vez con el libro de movimientos
+
+@bp.cli.command('inicializar-bd')
+def inicializar_bd():
+    """Crea tablas, columnas e índices nuevos y el admin (flask --app app inicializar-bd). Correr en cada deploy."""
+    init_db(); print('Base de datos lista')
+
+def create_app(config=None):
+    """Arma la app sin tocar la base de datos ni cargar pandas/Pillow: el arranque de cada worker es
+    liviano y con `gunicorn --preload` el proceso maestro no abre conexiones que luego compartirían los
+    workers. El esquema se prepara aparte con `flask --app app inicializar-bd`."""
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.config['USE_X_SENDFILE'] = app.config['SENDFILE_MODE'] == 'x-sendfile'
+    uri, replica = app.config['SQLALCHEMY_DATABASE_URI'], app.config['MYSQL_REPLICA_URL']
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config, uri, 'primaria'))
+    if replica:
+        app.config.setdefault('SQLALCHEMY_BINDS', {'replica': {'url': replica, **engine_options(app.config, replica, 'replica')}})
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    db.init_app(app)
+    login_manager.init_app(app)
+    metrics.init_app(app)
+    cache.init_app(app)
+    search_index.ttl = app.config['SEARCH_INDEX_TTL']  # se construye con el primer request de cada worker
+    app.register_blueprint(bp)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
+    with app.app_context(): init_db()
     # host=0.0.0.0 para que funcione en servidores remotos
     app.run(debug=True, host='0.0.0.0', port=5000)
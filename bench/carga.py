@@ -0,0 +1,335 @@
+"""Prueba de carga con el tráfico típico de la tienda, contra el test client de Flask o contra gunicorn real.
+
+Siembra una tienda sintética (productos, ubicaciones con stock, fotos, comandas) y corre usuarios virtuales
+que repiten escenarios elegidos al azar según la mezcla:
+  buscar      tipeo en el autocompletado: /api/search con cada letra
+  inventario  /inventario + sondeo de /api/stock (el segundo con If-None-Match) + detalle de un producto
+  comandas    formulario, alta de comanda, detalle, entrega y listado de /admin/comandas
+  importar    CSV de 200 filas por /admin/importar y espera del trabajo en segundo plano
+Reporta throughput, p50/p95/p99 y statements SQL por request de cada ruta (los SQL salen de /metrics, así
+valen igual para gunicorn con varios workers). Sin red: todo corre en 127.0.0.1.
+
+    python bench/carga.py [--modo cliente|gunicorn] [--productos 40000] [--hilos 4] [--iteraciones 25]
+                          [--mezcla buscar=50,inventario=30,comandas=15,importar=5] [--workers 3] [--threads 4]
+                          [--guardar base.json] [--comparar base.json] [--umbral 25]
+
+--comparar sale con código 1 si alguna ruta empeora más que --umbral % en p50/p95, si sube su número de
+queries o si baja el throughput total. Con MYSQL_URL apuntando a un MySQL local vacío se mide contra MySQL.
+"""
+import io, os, re, sys, json, time, uuid, random, socket, secrets, argparse, tempfile, threading, subprocess
+import http.client
+from collections import defaultdict
+from urllib.parse import urlencode
+import common
+
+RUN_DIR = tempfile.mkdtemp(prefix='carga-')
+os.environ.setdefault('METRICS_DIR', os.path.join(RUN_DIR, 'metrics'))
+os.environ.setdefault('UPLOAD_FOLDER', os.path.join(RUN_DIR, 'uploads'))
+os.environ.setdefault('METRICS_TOKEN', secrets.token_hex(8))
+os.makedirs(os.environ['UPLOAD_FOLDER'], exist_ok=True)
+
+from app import app, db, Product, User
+
+ADMIN = (os.environ.get('ADMIN_EMAIL', 'admin@tienda.com'), os.environ.get('ADMIN_PASSWORD', 'admin123'))
+TYPING = ['leche', 'azucar', 'cafe', 'aceite', 'galletas', 'frijol', 'jabon', '7500000012']
+MIX = {'buscar': 50, 'inventario': 30, 'comandas': 15, 'importar': 5}
+
+# ----------------- Clientes: test client o HTTP contra gunicorn -----------------
+def multipart(form, files):
+    boundary = uuid.uuid4().hex
+    out = []
+    for k, v in form.items():
+        out.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    for k, (name, data) in files.items():
+        out.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"; filename="{name}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    out.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(out), f'multipart/form-data; boundary={boundary}'
+
+class ClientDriver:
+    """Test client de Flask, en este mismo proceso (sin red ni serialización HTTP)."""
+    def __init__(self):
+        self.client = app.test_client()
+        with app.app_context(): admin = User.query.filter_by(email=ADMIN[0]).first()
+        with self.client.session_transaction() as s: s['_user_id'] = str(admin.id)
+
+    def request(self, method, url, form=None, files=None, json_body=None, headers=None):
+        data = dict(form or {})
+        for k, (name, content) in (files or {}).items():
+            data[k] = (io.BytesIO(content), name)
+        resp = self.client.open(url, method=method, data=data or None, json=json_body, headers=headers or {})
+        return resp.status_code, resp.get_data(), resp.headers
+
+class HttpDriver:
+    """http.client con keep-alive contra gunicorn; inicia sesión como admin por /login."""
+    def __init__(self, port):
+        self.port, self.cookie = port, None
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        status, _, headers = self.request('POST', '/login', form={'email': ADMIN[0], 'password': ADMIN[1]})
+        if status != 302: raise RuntimeError(f'login falló: {status}')
+
+    def request(self, method, url, form=None, files=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if files:
+            body, headers['Content-Type'] = multipart(form or {}, files)
+        elif form is not None:
+            body, headers['Content-Type'] = urlencode(form).encode(), 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            body, headers['Content-Type'] = json.dumps(json_body).encode(), 'application/json'
+        if self.cookie: headers['Cookie'] = self.cookie
+        for attempt in range(2):
+            try:
+                self.conn.request(method, url, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.conn.close()  # el worker cerró la conexión keep-alive: reintentar una vez
+                if attempt: raise
+        cookie = resp.getheader('Set-Cookie')
+        if cookie and cookie.startswith('session='): self.cookie = cookie.split(';', 1)[0]
+        return resp.status, data, resp.headers
+
+# ----------------- Escenarios -----------------
+class VirtualUser:
+    """Un usuario virtual: repite escenarios y anota (ruta, ms) de cada request."""
+    def __init__(self, driver, seed, n_products):
+        self.driver, self.rnd, self.n_products = driver, random.Random(seed), n_products
+        self.samples = []  # (endpoint, ms, status)
+        self.jobs = []     # ms de cada importación de punta a punta
+
+    def call(self, endpoint, method, url, **kw):
+        t0 = time.perf_counter()
+        status, body, headers = self.driver.request(method, url, **kw)
+        self.samples.append((endpoint, (time.perf_counter() - t0) * 1000, status))
+        if status >= 500: raise RuntimeError(f'{method} {url} -> {status}')
+        return status, body, headers
+
+    def buscar(self):
+        word = self.rnd.choice(TYPING)
+        for i in range(1, len(word) + 1):
+            self.call('main.api_search', 'GET', '/api/search?' + urlencode({'q': word[:i]}))
+
+    def inventario(self):
+        _, html, _ = self.call('main.inventario', 'GET', '/inventario')
+        ids = [int(i) for i in re.findall(rb'id="stock-(\d+)"', html)]
+        _, _, headers = self.call('main.api_stock_bulk', 'POST', '/api/stock', json_body={'ids': ids})
+        etag = headers.get('ETag')
+        self.call('main.api_stock_bulk', 'POST', '/api/stock', json_body={'ids': ids},
+                  headers={'If-None-Match': etag} if etag else None)
+        if ids: self.call('main.producto_detalle', 'GET', f'/producto/{self.rnd.choice(ids)}')
+
+    def comandas(self):
+        _, html, _ = self.call('main.comanda_nueva', 'GET', '/comanda/nueva')
+        key = re.search(rb'name="idempotency_key" value="(\w+)"', html).group(1).decode()
+        items = [{'sku': f'75{pid:010d}', 'nombre': '', 'cantidad': self.rnd.randint(1, 3)}
+                 for pid in self.rnd.sample(range(1, self.n_products + 1), min(5, self.n_products))]
+        _, _, headers = self.call('main.comanda_nueva', 'POST', '/comanda/nueva', form={
+            'requested_by': 'carga', 'requested_for_time': '10:00', 'items_json': json.dumps(items), 'idempotency_key': key})
+        order_id = int(headers['Location'].rstrip('/').rsplit('/', 1)[1])
+        self.call('main.comanda_ver', 'GET', f'/comanda/{order_id}')
+        self.call('main.admin_comanda_entregar', 'POST', f'/admin/comandas/{order_id}/entregar', form={})
+        self.call('main.admin_comandas', 'GET', '/admin/comandas?status=pendiente')
+
+    def importar(self, rows=200):
+        lines = ['sku,nombre,categoria,tipo,pasillo,rack,cantidad']
+        for _ in range(rows):
+            pid = self.rnd.randint(1, self.n_products * 11 // 10)  # ~10% SKUs nuevos
+            lines.append(f'75{pid:010d},Producto importado {pid},carga,{self.rnd.choice(["bodega", "piso"])},'
+                         f'{self.rnd.randint(1, 20)},{self.rnd.choice("ABC")},{self.rnd.randint(0, 30)}')
+        t0 = time.perf_counter()
+        _, _, headers = self.call('main.admin_importar', 'POST', '/admin/importar', form={},
+                                  files={'archivo': ('carga.csv', '\n'.join(lines).encode())})
+        job = int(re.search(r'job=(\d+)', headers['Location']).group(1))
+        while True:
+            _, body, _ = self.call('main.api_job', 'GET', f'/api/jobs/{job}')
+            status = json.loads(body)['status']
+            if status == 'error': raise RuntimeError(f'importación {job} falló')
+            if status == 'ok': break
+            time.sleep(0.05)
+        self.jobs.append((time.perf_counter() - t0) * 1000)
+
+def run_users(make_driver, n_users, iterations, mix, n_products, warmup=True):
+    weights = [(k, v) for k, v in mix.items() if v > 0]
+    users = [VirtualUser(make_driver(), seed=i, n_products=n_products) for i in range(n_users)]
+    if warmup:  # índice de búsqueda, cachés y conexiones listos antes de medir
+        for u in users:
+            for name in ('buscar', 'inventario'): getattr(u, name)()
+            u.samples.clear()
+    errors = []
+    def loop(u):
+        try:
+            for _ in range(iterations):
+                getattr(u, u.rnd.choices([k for k, _ in weights], [v for _, v in weights])[0])()
+        except Exception as e:
+            errors.append(repr(e))
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=loop, args=(u,)) for u in users]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    return users, time.perf_counter() - t0, errors
+
+# ----------------- /metrics: statements SQL por endpoint -----------------
+LINE = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def scrape(driver):
+    """{endpoint: (requests, statements)} desde /metrics (sumado entre workers)."""
+    _, body, _ = driver.request('GET', '/metrics', headers={'Authorization': f"Bearer {os.environ['METRICS_TOKEN']}"})
+    out = defaultdict(lambda: [0.0, 0.0])
+    for line in body.decode().splitlines():
+        m = LINE.match(line)
+        if not m: continue
+        labels = dict(LABEL.findall(m.group(2)))
+        if m.group(1) == 'http_requests_total': out[labels['endpoint']][0] += float(m.group(3))
+        elif m.group(1) == 'db_statements_total': out[labels['endpoint']][1] += float(m.group(3))
+    return out
+
+def report(users, elapsed, before, after, meta):
+    by_route = defaultdict(list)
+    for u in users:
+        for ep, ms, _ in u.samples: by_route[ep].append(ms)
+    total = sum(len(v) for v in by_route.values())
+    result = {'meta': meta, 'total': {'n': total, 'rps': total / elapsed, 'segundos': elapsed}, 'rutas': {}}
+    jobs = [ms for u in users for ms in u.jobs]
+    if jobs: result['importaciones'] = {'n': len(jobs), 'p50': common.percentile(jobs, 50), 'p95': common.percentile(jobs, 95)}
+    print(f"{'ruta':28s} {'n':>6s} {'req/s':>7s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'SQL/req':>8s}")
+    for ep, ms in sorted(by_route.items()):
+        reqs = after[ep][0] - before[ep][0]
+        sql = (after[ep][1] - before[ep][1]) / reqs if reqs else None
+        r = {'n': len(ms), 'rps': len(ms) / elapsed, 'p50': common.percentile(ms, 50),
+             'p95': common.percentile(ms, 95), 'p99': common.percentile(ms, 99), 'sql': sql}
+        result['rutas'][ep] = r
+        print(f"{ep:28s} {r['n']:6d} {r['rps']:7.1f} {r['p50']:8.1f} {r['p95']:8.1f} {r['p99']:8.1f} "
+              f"{'-' if sql is None else f'{sql:8.1f}':>8s}")
+    print(f"{'total':28s} {total:6d} {total / elapsed:7.1f}   en {elapsed:.1f} s")
+    if jobs: print(f"importación de punta a punta: p50={result['importaciones']['p50']:.0f} ms  p95={result['importaciones']['p95']:.0f} ms")
+    return result
+
+MIN_SAMPLES = {'p50': 20, 'p95': 100}  # con menos muestras el percentil es ruido: se muestra pero no se evalúa
+
+def compare(result, base, threshold):
+    """Lista de regresiones respecto de `base`. Diferencias de menos de 2 ms no cuentan (ruido); el número
+    de queries se evalúa siempre porque no depende de la máquina."""
+    if base['meta'] != result['meta']:
+        print(f"Aviso: la base se midió con otros parámetros: {base['meta']}")
+    regressions = []
+    print(f"\n{'ruta':28s} {'p50 base':>9s} {'p50':>8s} {'p95 base':>9s} {'p95':>8s} {'SQL base':>9s} {'SQL':>6s}")
+    for ep, r in sorted(result['rutas'].items()):
+        b = base['rutas'].get(ep)
+        if not b: continue
+        flags = []
+        for k in ('p50', 'p95'):
+            if min(r['n'], b['n']) < MIN_SAMPLES[k]: continue
+            if r[k] > b[k] * (1 + threshold / 100) and r[k] - b[k] > 2: flags.append(f'{k} +{(r[k] / b[k] - 1) * 100:.0f}%')
+        if r['sql'] is not None and b['sql'] is not None and r['sql'] > b['sql'] + 0.5:
+            flags.append(f"SQL {b['sql']:.1f} -> {r['sql']:.1f}")
+        sql_b = '-' if b['sql'] is None else f"{b['sql']:.1f}"
+        sql_r = '-' if r['sql'] is None else f"{r['sql']:.1f}"
+        print(f"{ep:28s} {b['p50']:9.1f} {r['p50']:8.1f} {b['p95']:9.1f} {r['p95']:8.1f} {sql_b:>9s} {sql_r:>6s}  "
+              + ('REGRESIÓN: ' + ', '.join(flags) if flags else 'ok'))
+        regressions += [f'{ep}: {f}' for f in flags]
+    rps_b, rps = base['total']['rps'], result['total']['rps']
+    if rps < rps_b * (1 - threshold / 100):
+        regressions.append(f'throughput total {rps_b:.1f} -> {rps:.1f} req/s')
+    print(f"{'throughput total':28s} {rps_b:9.1f} -> {rps:.1f} req/s")
+    return regressions
+
+# ----------------- gunicorn -----------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0)); return s.getsockname()[1]
+
+def start_gunicorn(workers, threads):
+    port = free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--preload', '--workers', str(workers), '--threads', str(threads),
+           '--bind', f'127.0.0.1:{port}', '--timeout', '120', '--log-level', 'warning']
+    env = dict(os.environ, WEB_THREADS=str(threads))
+    proc = subprocess.Popen(cmd, cwd=common.ROOT, env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/login'); conn.getresponse().read(); conn.close()
+            return proc, port
+        except OSError:
+            if proc.poll() is not None: raise RuntimeError('gunicorn no arrancó')
+            time.sleep(0.2)
+    proc.terminate(); raise RuntimeError('gunicorn no respondió en 60 s')
+
+def drain(port, n):
+    """Cada worker vuelca sus métricas como mucho cada 5 s y solo al atender un request: esperar y
+    mandar algunos requests livianos para que todos escriban su archivo antes de leer /metrics."""
+    time.sleep(5.5)
+    for _ in range(n):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('GET', '/login'); conn.getresponse().read(); conn.close()
+
+# ----------------- main -----------------
+def parse_mix(text):
+    mix = dict(MIX)
+    for part in filter(None, (text or '').split(',')):
+        k, v = part.split('=')
+        if k not in MIX: raise SystemExit(f'escenario desconocido: {k} (hay {", ".join(MIX)})')
+        mix[k] = int(v)
+    return mix
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--modo', choices=['cliente', 'gunicorn'], default='cliente')
+    ap.add_argument('--productos', type=int, default=40000)
+    ap.add_argument('--comandas', type=int, default=200)
+    ap.add_argument('--hilos', type=int, default=4, help='usuarios virtuales concurrentes')
+    ap.add_argument('--iteraciones', type=int, default=25, help='escenarios por usuario')
+    ap.add_argument('--mezcla', default='')
+    ap.add_argument('--workers', type=int, default=3)
+    ap.add_argument('--threads', type=int, default=4)
+    ap.add_argument('--guardar')
+    ap.add_argument('--comparar')
+    ap.add_argument('--umbral', type=float, default=25, help='%% de empeoramiento tolerado en p50/p95 y throughput')
+    args = ap.parse_args()
+    mix = parse_mix(args.mezcla)
+
+    common.init_db(app)
+    with app.app_context():
+        if Product.query.first(): raise SystemExit('La base ya tiene productos: usar una base vacía (ver MYSQL_URL)')
+        t0 = time.perf_counter()
+        common.seed_store(args.productos, args.comandas)
+        backend = db.engine.url.get_backend_name()
+        print(f"{args.productos} productos y {args.comandas} comandas sembrados en {time.perf_counter() - t0:.1f} s ({backend})")
+
+    meta = {'modo': args.modo, 'productos': args.productos, 'hilos': args.hilos, 'iteraciones': args.iteraciones,
+            'mezcla': mix, 'backend': backend}
+    proc = None
+    try:
+        if args.modo == 'gunicorn':
+            meta.update(workers=args.workers, threads=args.threads)
+            proc, port = start_gunicorn(args.workers, args.threads)
+            make_driver = lambda: HttpDriver(port)
+            settle = lambda: drain(port, args.workers * args.threads * 4)
+        else:
+            app.config['JOBS_RUNNER'] = True
+            make_driver, settle = ClientDriver, lambda: None
+        probe = make_driver()
+        settle(); before = scrape(probe)
+        users, elapsed, errors = run_users(make_driver, args.hilos, args.iteraciones, mix, args.productos)
+        settle(); after = scrape(probe)
+        result = report(users, elapsed, before, after, meta)
+    finally:
+        if proc: proc.terminate(); proc.wait(10)
+    if errors:
+        print(f'{len(errors)} usuarios cortados por error:', *sorted(set(errors))[:5], sep='\n  ')
+    if args.guardar:
+        with open(args.guardar, 'w') as f: json.dump(result, f, indent=1)
+        print('Base guardada en', args.guardar)
+    failed = bool(errors)
+    if args.comparar:
+        with open(args.comparar) as f: base = json.load(f)
+        regressions = compare(result, base, args.umbral)
+        if regressions:
+            print(f'\n{len(regressions)} regresiones (umbral {args.umbral:g}%):', *regressions, sep='\n  ')
+            failed = True
+        else:
+            print(f'\nSin regresiones (umbral {args.umbral:g}%)')
+    sys.exit(1 if failed else 0)
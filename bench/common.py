@@ -0,0 +1,65 @@
+"""Utilidades compartidas por los benchmarks: BD SQLite temporal y catálogo sintético.
+
+Importar este módulo ANTES que `app`: fija MYSQL_URL a un SQLite desechable para no tocar data.db.
+"""
+import os, sys, random, tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+if 'MYSQL_URL' not in os.environ:
+    _tmp = tempfile.mkdtemp(prefix='bench-')
+    os.environ['MYSQL_URL'] = 'sqlite:///' + os.path.join(_tmp, 'bench.db')
+
+WORDS = ['leche', 'azúcar', 'arroz', 'café', 'jabón', 'aceite', 'atún', 'galletas', 'pan', 'frijol',
+         'entera', 'deslactosada', 'morena', 'integral', 'líquido', 'oliva', 'agua', 'light', 'grande', 'niño']
+
+def init_db(app):
+    """Crea el esquema del SQLite temporal (la app ya no lo hace al importarse, ver `inicializar-bd`)."""
+    import app as module
+    with app.app_context(): module.init_db()
+
+def seed_catalog(db, Product, ProductLocation, n=40000, seed=1, start=1):
+    """Inserta `n` productos (ids desde `start`) con 1-3 ubicaciones cada uno, en lotes y sin ORM por fila.
+    Product.stock queda consistente; los movimientos de apertura los crea reconcile_stock() si se necesitan."""
+    rnd = random.Random(seed + start)
+    products, locations = [], []
+    for i in range(start, start + n):
+        nombre = ' '.join(rnd.sample(WORDS, 3)).capitalize() + f' {rnd.randint(100, 999)}g'
+        locs = [{'product_id': i, 'tipo': tipo, 'pasillo': str(rnd.randint(1, 20)),
+                 'rack': rnd.choice('ABCDEF'), 'cantidad': rnd.randint(0, 50)}
+                for tipo in rnd.sample(['bodega', 'trastienda', 'piso'], rnd.randint(1, 3))]
+        products.append({'id': i, 'sku': f'75{i:010d}', 'nombre': nombre, 'categoria': rnd.choice(WORDS),
+                         'stock': sum(l['cantidad'] for l in locs)})
+        locations += locs
+    for rows, table in ((products, Product.__table__), (locations, ProductLocation.__table__)):
+        for i in range(0, len(rows), 20000):
+            db.session.execute(table.insert(), rows[i:i + 20000])
+    db.session.commit()
+
+def seed_store(n_products=40000, n_orders=200, photos=1, items=(2, 8), seed=1):
+    """Tienda completa para pruebas de carga: catálogo con 1-3 ubicaciones por producto (seed_catalog),
+    `photos` fotos por ubicación y `n_orders` comandas (la mitad entregadas) con sus items. Todo en bloque."""
+    from app import db, Product, ProductLocation, ProductLocationPhoto, Order, OrderItem
+    seed_catalog(db, Product, ProductLocation, n_products, seed=seed)
+    rnd = random.Random(seed)
+    loc_ids = [lid for (lid,) in db.session.query(ProductLocation.id)]
+    rows = [{'location_id': lid, 'filename': f'{rnd.getrandbits(128):032x}.jpg'} for lid in loc_ids for _ in range(photos)]
+    for i in range(0, len(rows), 20000):
+        db.session.execute(ProductLocationPhoto.__table__.insert(), rows[i:i + 20000])
+    orders = [{'id': i, 'requested_by': f'cajero{i % 7}@tienda.com', 'requested_for_time': f'{8 + i % 12:02d}:00',
+               'status': 'entregado' if i % 2 else 'pendiente'} for i in range(1, n_orders + 1)]
+    lines = []
+    for o in orders:
+        for pid in rnd.sample(range(1, n_products + 1), min(rnd.randint(*items), n_products)):
+            lines.append({'order_id': o['id'], 'sku': f'75{pid:010d}', 'nombre': f'Producto {pid}', 'cantidad': rnd.randint(1, 5)})
+    if orders: db.session.execute(Order.__table__.insert(), orders)
+    if lines: db.session.execute(OrderItem.__table__.insert(), lines)
+    db.session.commit()
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values: return 0.0
+    k = (len(values) - 1) * p / 100
+    lo = int(k); hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
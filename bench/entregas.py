@@ -0,0 +1,66 @@
+"""Prueba de estrés de entregas concurrentes: varios bodegueros entregando comandas con SKUs en común.
+
+Verifica que no se pierdan descuentos: para cada ubicación, stock inicial - stock final debe ser igual a lo
+registrado en StockMovement, nunca negativo, y cada comanda se entrega una sola vez.
+
+    python bench/entregas.py [hilos] [comandas]
+"""
+import sys, random, threading, time
+from collections import defaultdict
+import common
+from app import app, db, Product, ProductLocation, Order, OrderItem, StockMovement, deliver_order
+common.init_db(app)
+
+def seed(n_orders, n_products=20, seed=7):
+    rnd = random.Random(seed)
+    for i in range(n_products):
+        p = Product(sku=f'S{i:03d}', nombre=f'Producto {i}', stock=0)
+        db.session.add(p)
+        for tipo in ['bodega', 'trastienda', 'piso']:
+            loc = ProductLocation(product=p, tipo=tipo, cantidad=rnd.randint(0, 40))
+            db.session.add(loc); p.stock += loc.cantidad
+    for i in range(n_orders):
+        o = Order(requested_by=f'tester{i}', status='pendiente')
+        db.session.add(o)
+        for sku in rnd.sample(range(n_products), 5):
+            db.session.add(OrderItem(order=o, sku=f'S{sku:03d}', nombre=f'Producto {sku}', cantidad=rnd.randint(1, 15)))
+    db.session.commit()
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    n_orders = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    with app.app_context():
+        seed(n_orders)
+        before = dict(db.session.query(ProductLocation.id, ProductLocation.cantidad))
+        order_ids = [o.id for o in Order.query]
+        requested = dict(db.session.query(OrderItem.id, OrderItem.cantidad))
+    results, errors = defaultdict(int), []
+    def worker(ids):
+        with app.app_context():
+            for oid in ids:
+                try: results['entregada' if deliver_order(oid, 'bench') is not None else 'repetida'] += 1
+                except Exception as e: errors.append(repr(e)); db.session.rollback()
+    # todos los hilos intentan entregar todas las comandas, cada uno en distinto orden
+    plan = [random.Random(t).sample(order_ids, len(order_ids)) for t in range(threads)]
+    t0 = time.perf_counter()
+    ts = [threading.Thread(target=worker, args=(ids,)) for ids in plan]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    elapsed = time.perf_counter() - t0
+    with app.app_context():
+        after = dict(db.session.query(ProductLocation.id, ProductLocation.cantidad))
+        moved = dict(db.session.query(StockMovement.location_id, db.func.sum(StockMovement.cantidad)).group_by(StockMovement.location_id))
+        per_item = dict(db.session.query(StockMovement.order_item_id, db.func.sum(-StockMovement.cantidad)).group_by(StockMovement.order_item_id))
+        delivered = Order.query.filter_by(status='entregado').count()
+        totals = dict(db.session.query(ProductLocation.product_id, db.func.sum(ProductLocation.cantidad)).group_by(ProductLocation.product_id))
+        bad_totals = [pid for pid, stock in db.session.query(Product.id, Product.stock) if stock != totals.get(pid, 0)]
+        unchanged = dict(db.session.query(OrderItem.id, OrderItem.cantidad)) == requested
+    lost = [lid for lid in before if before[lid] + moved.get(lid, 0) != after[lid]]
+    negative = [lid for lid, c in after.items() if c < 0]
+    over = [iid for iid, n in per_item.items() if n > requested[iid]]
+    print(f'{threads} hilos, {n_orders} comandas en {elapsed:.2f} s: {dict(results)}, errores={len(errors)}')
+    print(f'comandas entregadas={delivered} descuentos perdidos={len(lost)} stock negativo={len(negative)} '
+          f'items con exceso={len(over)} Product.stock distinto={len(bad_totals)} OrderItem.cantidad intacto={unchanged}')
+    for e in errors[:5]: print('  ', e)
+    ok = not lost and not negative and not over and not bad_totals and unchanged and delivered == n_orders and results['entregada'] == n_orders
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,83 @@
+"""Exportación CSV/XLSX: memoria pico con catálogos de distinto tamaño y prueba de ida y vuelta
+(exportar -> borrar -> importar -> exportar debe dar las mismas filas, y volver a importar sin borrar
+también: las ubicaciones existentes se actualizan, no se duplican).
+
+    python bench/exportar.py [productos]   # 200000 productos ~ 400k filas
+"""
+import io, sys, time, tracemalloc
+from collections import Counter
+import common
+from app import (app, db, job_runner, Product, ProductLocation, ProductLocationPhoto, StockMovement, User, import_products,
+                 read_import_file)
+common.init_db(app)
+app.config['JOBS_RUNNER'] = False  # el trabajo de XLSX se ejecuta en download(), no en hilos del runner
+
+def download(client, formato):
+    """Descarga leyendo la respuesta por bloques, como un cliente real; devuelve bytes, ms y memoria pico.
+    El XLSX lo arma un trabajo: se ejecuta acá mismo y se descarga el archivo que deja."""
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    resp = (client.post if formato == 'xlsx' else client.get)(f'/admin/exportar.{formato}', buffered=False)
+    if formato == 'xlsx':
+        assert resp.status_code == 302, resp.status_code
+        with app.app_context(): job_runner.run_pending()
+        resp = client.get(resp.headers['Location'] + '/archivo', buffered=False)
+    assert resp.status_code == 200, resp.status_code
+    out, size = io.BytesIO(), 0
+    for chunk in resp.response:
+        chunk = chunk.encode() if isinstance(chunk, str) else chunk
+        size += len(chunk)
+        if formato == 'xlsx' or keep: out.write(chunk)
+    resp.close()
+    ms = (time.perf_counter() - t0) * 1000
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    return out.getvalue(), size, ms, peak
+
+def rows_of(data, formato):
+    df = read_import_file(io.BytesIO(data), f'x.{formato}').fillna('')
+    return Counter(tuple(str(v) for v in r) for r in df.itertuples(index=False))
+
+def reimport(data, formato, clear=True):
+    with app.app_context():
+        if clear:
+            for model in (StockMovement, ProductLocationPhoto, ProductLocation, Product):
+                db.session.query(model).delete()
+            db.session.commit()
+        res = import_products(read_import_file(io.BytesIO(data), f'x.{formato}'))
+        assert not res['errors'], res['errors'][:5]
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with app.app_context():
+        admin = User.query.filter_by(role='admin').first()
+    client = app.test_client()
+    with client.session_transaction() as s: s['_user_id'] = str(admin.id)
+    keep, seeded = False, 0
+    for size in (n // 10, n):
+        with app.app_context():
+            common.seed_catalog(db, Product, ProductLocation, size - seeded, start=seeded + 1); seeded = size
+            rows = db.session.query(ProductLocation).count()
+        _, nbytes, ms, peak = download(client, 'csv')
+        print(f'csv  {size:>7} productos {rows:>7} filas  {nbytes / 2**20:6.1f} MiB en {ms:7.0f} ms  memoria pico={peak / 2**10:7.0f} KiB')
+    keep = True
+    with app.app_context():  # casos borde: sin ubicaciones, comillas, saltos de línea, sku con ceros a la izquierda
+        db.session.add(Product(sku='0007', nombre='Sin ubicación, con "comillas"', comentarios='línea 1\nlínea 2', stock=0))
+        db.session.commit()
+    for formato, limit in (('csv', None), ('xlsx', 5000)):
+        if limit and seeded > limit:  # openpyxl es lento: la ida y vuelta en xlsx se hace con un catálogo más chico
+            with app.app_context():
+                ids = [i for i, in db.session.query(Product.id).filter(Product.id > limit)]
+                db.session.query(StockMovement).filter(StockMovement.product_id.in_(ids)).delete()
+                db.session.query(ProductLocation).filter(ProductLocation.product_id > limit).delete()
+                db.session.query(Product).filter(Product.id > limit).delete()
+                db.session.add(Product(sku='0007', nombre='Sin ubicación, con "comillas"', comentarios='línea 1\nlínea 2', stock=0))
+                db.session.commit()
+            seeded = limit
+        first, _, ms, peak = download(client, formato)
+        t0 = time.perf_counter(); reimport(first, formato); imp = time.perf_counter() - t0
+        second, *_ = download(client, formato)
+        reimport(second, formato, clear=False)  # importar lo exportado sobre el mismo catálogo no duplica ubicaciones
+        third, *_ = download(client, formato)
+        ok = rows_of(first, formato) == rows_of(second, formato) == rows_of(third, formato)
+        print(f'{formato:4s} ida y vuelta: {"OK" if ok else "DISTINTO"}  (exportar {ms:.0f} ms, memoria pico {peak / 2**10:.0f} KiB, importar {imp:.1f} s)')
+        if not ok: sys.exit(1)
@@ -0,0 +1,42 @@
+"""Tiempo, memoria y número de queries por request de /inventario según el tamaño del catálogo.
+
+    python bench/inventario.py 500 50000 500000
+"""
+import sys, time, tracemalloc
+import common
+from sqlalchemy import event
+from app import app, db, Product, ProductLocation, User
+common.init_db(app)
+
+def measure(client, engine, url, rounds=5):
+    counter = {'n': 0}
+    def count(*_): counter['n'] += 1
+    event.listen(engine, 'before_cursor_execute', count)
+    times, peak = [], 0
+    try:
+        for _ in range(rounds):
+            counter['n'] = 0
+            tracemalloc.start()
+            t0 = time.perf_counter(); resp = client.get(url); times.append((time.perf_counter() - t0) * 1000)
+            peak = max(peak, tracemalloc.get_traced_memory()[1]); tracemalloc.stop()
+            assert resp.status_code == 200, resp.status_code
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return resp, times, counter['n'], peak
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or [500, 50000]
+    seeded = 0
+    with app.app_context():
+        admin, engine = User.query.filter_by(role='admin').first(), db.engine
+    client = app.test_client()
+    with client.session_transaction() as s: s['_user_id'] = str(admin.id)
+    for n in sizes:
+        with app.app_context():
+            common.seed_catalog(db, Product, ProductLocation, n - seeded, start=seeded + 1); seeded = n
+        for url in ['/inventario', '/api/inventario', '/inventario?pasillo=7']:
+            resp, ms, queries, peak = measure(client, engine, url)
+            print(f'{n:>7} {url:22s} p50={common.percentile(ms, 50):7.2f} ms  queries={queries}  mem_pico={peak / 1024:7.0f} KiB')
+        cursor = client.get('/api/inventario').json['next_cursor']
+        resp, ms, queries, _ = measure(client, engine, f'/api/inventario?cursor={cursor}')
+        print(f'{n:>7} {"/api/inventario (p.2)":22s} p50={common.percentile(ms, 50):7.2f} ms  queries={queries}')
@@ -0,0 +1,72 @@
+"""Verifica el presupuesto de queries SQL (@query_budget) de cada vista con datos de distintos tamaños.
+Sale con código 1 si alguna vista se pasa: así un N+1 nuevo se detecta antes de llegar a producción.
+
+    python bench/query_budget.py
+"""
+import sys
+import common
+from sqlalchemy import event
+from app import (app, db, Product, ProductLocation, ProductLocationPhoto, Order, OrderItem, OrderItemPhoto,
+                 User, QueryBudgetExceeded, search_index)
+common.init_db(app)
+
+def seed(n_products, items_per_order, n_orders=40):
+    start = (Product.query.order_by(Product.id.desc()).first() or Product(id=0)).id + 1
+    common.seed_catalog(db, Product, ProductLocation, n_products, start=start)
+    for loc in ProductLocation.query.filter(ProductLocation.product_id >= start):
+        db.session.add_all(ProductLocationPhoto(location_id=loc.id, filename=f'foto{loc.id}_{k}.jpg') for k in range(2))
+    for i in range(n_orders):
+        o = Order(requested_by='admin@tienda.com'); db.session.add(o)
+        for k in range(items_per_order):
+            pid = start + (i * items_per_order + k) % n_products
+            it = OrderItem(order=o, sku=f'75{pid:010d}', nombre=f'Producto {pid}', cantidad=1)
+            db.session.add(it); db.session.add(OrderItemPhoto(item=it, filename=f'item{i}_{k}.jpg'))
+    db.session.commit()
+    search_index.rebuild()
+    return start
+
+def urls(first_product):
+    order = Order.query.order_by(Order.id.desc()).first()
+    cursor, order = f'{order.created_at.isoformat()}_{order.id}', order.id
+    return {
+        'main.home': '/', 'main.inventario': '/inventario', 'main.api_inventario': '/api/inventario?limit=200',
+        'main.producto_detalle': f'/producto/{first_product}', 'main.api_search': '/api/search?q=leche',
+        'main.api_stock': f'/api/stock/{first_product}',
+        'main.api_stock_bulk': ('POST', '/api/stock', {'ids': list(range(first_product, first_product + 500))}),
+        'main.comanda_ver': f'/comanda/{order}', 'main.admin_comandas': '/admin/comandas',
+        'main.admin_comandas ': f'/admin/comandas?status=pendiente&cursor={cursor}',
+    }
+
+if __name__ == '__main__':
+    app.config['QUERY_BUDGET_STRICT'] = True
+    app.testing = True  # la excepción llega hasta acá en vez de un 500
+    app.config['JOBS_RUNNER'] = False
+    budgeted = {ep for ep, fn in app.view_functions.items() if hasattr(fn, 'query_budget')}
+    with app.app_context():
+        admin, engine = User.query.filter_by(role='admin').first(), db.engine
+    client = app.test_client()
+    with client.session_transaction() as s: s['_user_id'] = str(admin.id)
+    counter = {'n': 0}
+    event.listen(engine, 'before_cursor_execute', lambda *_: counter.__setitem__('n', counter['n'] + 1))
+    failures, covered = [], set()
+    for n_products, items in [(50, 3), (2000, 60)]:
+        with app.app_context():
+            first = seed(n_products, items)
+            targets = urls(first)
+        for name, target in targets.items():
+            method, url, body = target if isinstance(target, tuple) else ('GET', target, None)
+            endpoint = name.strip(); covered.add(endpoint)
+            counter['n'] = 0
+            try:
+                resp = client.open(url, method=method, json=body)
+                status = resp.status_code
+            except QueryBudgetExceeded as e:
+                status = str(e)
+            budget = app.view_functions[endpoint].query_budget
+            ok = status == 200 and counter['n'] <= budget
+            if not ok: failures.append(name)
+            print(f"{'ok ' if ok else 'MAL'} {n_products:>5} productos/{items:>2} items  {url[:60]:60s} "
+                  f"queries={counter['n']:>3} presupuesto={budget} ({status})")
+    missing = budgeted - covered
+    if missing: print('Vistas con presupuesto sin URL de prueba:', ', '.join(sorted(missing)))
+    sys.exit(1 if failures or missing else 0)
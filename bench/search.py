@@ -0,0 +1,30 @@
+"""p50/p95 de /api/search: índice en memoria vs. ilike original.
+
+    python bench/search.py [n_productos]
+"""
+import sys, time
+import common
+from app import app, db, Product, ProductLocation, search_index, search_ilike, search_payload
+common.init_db(app)
+
+TERMS = ['l', 'le', 'lec', 'lech', 'leche', 'leche ent', 'azucar', 'Azúcar', 'cafe', '0123', '7500000', 'oliva 5', 'xyz']
+
+def run(fn, rounds=20):
+    times = []
+    with app.test_request_context():
+        for _ in range(rounds):
+            for t in TERMS:
+                t0 = time.perf_counter(); [search_payload(p) for p in fn(t)]
+                times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    with app.app_context():
+        common.seed_catalog(db, Product, ProductLocation, n)
+        t0 = time.perf_counter(); search_index.rebuild()
+        print(f'{n} productos, índice construido en {(time.perf_counter() - t0) * 1000:.0f} ms')
+        from app import search_products
+        for name, fn in [('ilike', search_ilike), ('indice', search_products)]:
+            ms = run(fn)
+            print(f'{name:7s} p50={common.percentile(ms, 50):7.2f} ms  p95={common.percentile(ms, 95):7.2f} ms')
@@ -0,0 +1,55 @@
+"""Arranque en frío de un worker: tiempo de `import app`, tiempo hasta la primera respuesta y memoria (RSS).
+Cada medición corre en un proceso nuevo, como un worker de gunicorn recién creado.
+
+    python bench/startup.py [rondas] [--antes <rev de git>]   # --antes compara con otra versión de app.py
+"""
+import os, sys, json, subprocess, tarfile, tempfile, io
+import common
+
+PROBE = r'''
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.app.test_client().get('/login')
+t2 = time.perf_counter()
+def rss():
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(l.split()[1]) for l in f if l.startswith('VmRSS'))
+    except OSError:
+        import resource; return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'import': t1 - t0, 'primera': t2 - t1, 'rss': rss(), 'pandas': 'pandas' in sys.modules}))
+'''
+
+def checkout(rev):
+    """app.py + templates de `rev` en un directorio temporal."""
+    out = tempfile.mkdtemp(prefix='startup-')
+    data = subprocess.run(['git', 'archive', rev, 'app.py', 'templates', 'static'], cwd=common.ROOT,
+                          capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar: tar.extractall(out)
+    return out
+
+def measure(folder, rounds):
+    env = dict(os.environ, JOBS_RUNNER='0', PYTHONDONTWRITEBYTECODE='1')
+    setup = 'import app\nif hasattr(app, "init_db"):\n    with app.app.app_context(): app.init_db()'
+    subprocess.run([sys.executable, '-c', setup], cwd=folder, env=env, check=True)  # esquema listo (y bytecode)
+    runs = [json.loads(subprocess.run([sys.executable, '-c', PROBE], cwd=folder, env=env, capture_output=True,
+                                      text=True, check=True).stdout.splitlines()[-1]) for _ in range(rounds)]
+    return runs
+
+def report(label, runs):
+    imp = [r['import'] * 1000 for r in runs]; first = [r['primera'] * 1000 for r in runs]
+    rss = [r['rss'] / 1024 for r in runs]
+    print(f"{label:8s} import p50={common.percentile(imp, 50):6.0f} ms  primera respuesta p50={common.percentile(first, 50):6.0f} ms  "
+          f"RSS p50={common.percentile(rss, 50):5.0f} MiB  pandas cargado={runs[0]['pandas']}")
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    rev = None
+    if '--antes' in args:
+        i = args.index('--antes'); rev = args[i + 1]; del args[i:i + 2]
+    rounds = int(args[0]) if args else 5
+    if rev:
+        report(rev[:8], measure(checkout(rev), rounds))
+    report('actual', measure(common.ROOT, rounds))
@@ -0,0 +1,27 @@
+// Utilidades de las páginas de admin (comandas, importar, exportar).
+
+// Escapa texto para armarlo dentro de innerHTML.
+const esc = s => String(s ?? '').replace(/[&<>"']/g, c => ({'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c]));
+
+// Sigue un trabajo en segundo plano: consulta `url` (/api/jobs/<id>) cada segundo mientras esté pendiente o
+// en curso, actualiza #job-status y #job-bar y llama a render(trabajo, #job-result) para mostrar el resultado.
+function pollJob(url, render){
+  const out = document.getElementById('job-result');
+  function show(j){
+    document.getElementById('job-status').textContent = j.status;
+    const bar = document.getElementById('job-bar');
+    bar.style.width = j.progress + '%'; bar.textContent = j.progress + '%';
+    bar.classList.toggle('bg-danger', j.status==='error');
+    bar.classList.toggle('bg-success', j.status==='ok');
+    if(j.status==='error'){ out.innerHTML = `<div class="text-danger">${esc(j.error)}</div>`; return; }
+    render(j, out);
+  }
+  async function poll(){
+    const res = await fetch(url);
+    if(!res.ok) return;
+    const j = await res.json();
+    show(j);
+    if(j.status==='pendiente' || j.status==='en_curso') setTimeout(poll, 1000);
+  }
+  poll();
+}